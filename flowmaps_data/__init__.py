@@ -1,2 +1,6 @@
 from .main import main
 from .data import *
+from .utils import FlowmapsClient
+from .sync import sync_daily_mobility
+from .cube import MobilityCube
+from .zones import ZoneIndex
@@ -0,0 +1,171 @@
+"""Asyncio versions of the functions in `flowmaps_data.data`.
+
+They share an `AsyncFlowmapsClient`, whose semaphore bounds the number of
+requests in flight, so many downloads can be interleaved on a single event
+loop. Requires aiohttp (pip install aiohttp).
+
+"""
+import asyncio
+import json
+import math
+
+from .utils import API_URL
+from .decoders import get_decoder
+from .data import (
+    _geolayer_query, _geolayer_result,
+    _covid19_query, _covid19_result,
+    _dataset_query, _dataset_result,
+    _daily_mobility_query, _daily_mobility_result,
+    _population_query, _population_result,
+    _zone_movements_query, _zone_movements_result,
+    _risk_queries, _risk_result,
+)
+
+
+class AsyncFlowmapsClient:
+
+    def __init__(self, api_url=API_URL, pool_size=10, max_concurrency=10, timeout=None, decoder='auto'):
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise ImportError(f"{e}. To use flowmaps_data.aio you need to install aiohttp, for example: pip install aiohttp")
+        self._aiohttp = aiohttp
+        self.api_url = api_url.rstrip('/')
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.loads = get_decoder(decoder)
+        self._session = None
+        self._semaphore = None
+
+    async def get(self, path, params=None):
+        # the session and the semaphore are bound to the running loop, so they
+        # are created on first use instead of in __init__
+        if self._session is None:
+            connector = self._aiohttp.TCPConnector(limit=self.pool_size)
+            timeout = self._aiohttp.ClientTimeout(total=self.timeout)
+            self._session = self._aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        url = f"{self.api_url}/{path}"
+        async with self._semaphore:
+            async with self._session.get(url, params=params) as response:
+                return await response.json(content_type=None, loads=self.loads)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+async def fetch_first(collection, query, projection={}, client=None):
+    if client is None:
+        async with AsyncFlowmapsClient() as client:
+            return await fetch_first(collection, query, projection=projection, client=client)
+    params = {'where': json.dumps(query), 'max_results': 1, 'projection': json.dumps(projection)}
+    response = await client.get(collection, params)
+    if not response or not response.get('_items'):
+        return None
+    return response['_items'][0]
+
+
+async def fetch_all_pages(collection, query, batch_size=1000, projection={}, sort=None, print_url=False, client=None):
+    if client is None:
+        async with AsyncFlowmapsClient() as client:
+            return await fetch_all_pages(collection, query, batch_size=batch_size, projection=projection, sort=sort, print_url=print_url, client=client)
+    params = {'where': json.dumps(query), 'max_results': batch_size, 'projection': json.dumps(projection)}
+    if sort:
+        params['sort'] = sort
+    if print_url:
+        print(f"API request: {client.api_url}/{collection}?where={params['where']}")
+    response = await client.get(collection, params) # get first page
+    data = list(response['_items'])
+    if '_links' not in response or response['_meta']['total'] <= 0:
+        return data
+    # the server may cap max_results, so use the page size it actually applied
+    page_size = response['_meta'].get('max_results', batch_size)
+    num_pages = math.ceil(response['_meta']['total'] / page_size)
+    pages = await asyncio.gather(*[client.get(collection, {**params, 'page': page}) for page in range(2, num_pages + 1)])
+    for page in pages:
+        data.extend(page['_items'])
+    return data
+
+
+async def geolayer(layer, print_url=False, client=None):
+    collection, filters, projection = _geolayer_query(layer)
+    data = await fetch_all_pages(collection, filters, projection=projection, print_url=print_url, client=client)
+    return _geolayer_result(data)
+
+
+async def covid19(ev, start_date=None, end_date=None, print_url=False, columns=None, client=None):
+    collection, filters, projection = _covid19_query(ev, start_date, end_date, columns)
+    data = await fetch_all_pages(collection, filters, projection=projection, print_url=print_url, client=client)
+    return _covid19_result(data, columns)
+
+
+async def dataset(ev, start_date=None, end_date=None, print_url=False, columns=None, client=None):
+    collection, filters, projection = _dataset_query(ev, start_date, end_date, columns)
+    data = await fetch_all_pages(collection, filters, projection=projection, print_url=print_url, client=client)
+    return _dataset_result(data, columns)
+
+
+async def daily_mobility(source_layer, target_layer, start_date=None, end_date=None, source=None, target=None, print_url=False, columns=None, client=None):
+    collection, filters, projection = _daily_mobility_query(source_layer, target_layer, start_date, end_date, source, target, columns)
+    data = await fetch_all_pages(collection, filters, projection=projection, print_url=print_url, client=client)
+    return _daily_mobility_result(data, columns)
+
+
+async def population(layer, start_date=None, end_date=None, print_url=False, columns=None, client=None):
+    collection, filters, projection = _population_query(layer, start_date, end_date, columns)
+    data = await fetch_all_pages(collection, filters, projection=projection, print_url=print_url, client=client)
+    return _population_result(data, columns)
+
+
+async def zone_movements(layer, start_date=None, end_date=None, print_url=False, columns=None, client=None):
+    collection, filters, projection = _zone_movements_query(layer, start_date, end_date, columns)
+    data = await fetch_all_pages(collection, filters, projection=projection, print_url=print_url, client=client)
+    return _zone_movements_result(layer, data, columns)
+
+
+async def _fetch_query(query, client):
+    collection, filters, projection = query
+    return await fetch_all_pages(collection, filters, projection=projection, client=client)
+
+
+async def risk(source_layer, target_layer, ev, date=None, start_date=None, end_date=None, client=None):
+    if client is None:
+        async with AsyncFlowmapsClient() as client:
+            return await risk(source_layer, target_layer, ev, date, start_date, end_date, client=client)
+    if date:
+        start_date = end_date = date
+    if not start_date and not end_date:
+        raise Exception('risk needs a date, or a start_date and end_date')
+    queries = _risk_queries(source_layer, target_layer, ev, start_date, end_date)
+
+    # mobility and cases are independent, fetch them at the same time
+    mobility, cases = await asyncio.gather(
+        _fetch_query(queries['mobility'], client),
+        _fetch_query(queries['cases'], client),
+    )
+    if not mobility:
+        raise Exception(f"Missing mobility data matching: {queries['mobility'][1]}")
+    if not cases:
+        raise Exception(f"Missing Covid19 data matching: {queries['cases'][1]}")
+
+    population = None
+    if not any('population' in doc for doc in cases):
+        population = await _fetch_query(queries['population'], client)
+        if not population:
+            raise Exception(f"Missing population data matching: {queries['population'][1]}")
+
+    return _risk_result(mobility, cases, population)
+
+
+async def deceased(ev, start_date=None, end_date=None, print_url=False, columns=None, client=None):
+    # deceased datasets are no consolidated, so they can just be downloaded as any other dataset
+    return await dataset(ev, start_date=start_date, end_date=end_date, print_url=print_url, columns=columns, client=client)
@@ -0,0 +1,215 @@
+import os
+import copy
+import json
+import time
+import hashlib
+import threading
+
+from .decoders import get_decoder
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'flowmaps_data')
+
+DEFAULT_MAX_SIZE = 1024**3 # 1 GB
+
+DAY = 24 * 3600
+
+# how long (in seconds) a cached response is used without asking the API again,
+# by collection. None means it never expires. Any collection may change, so
+# by default responses are revalidated on every use, which costs a 304
+# without payload when they did not change.
+DEFAULT_TTLS = {
+    'provenance': 0,
+    'distinct': 0,
+    'layers': 0,
+    'layers.data': 0,
+    'layers.data.consolidated': 0,
+}
+
+DEFAULT_TTL = 0
+
+# past days of mobility data do not change once published, the queries that
+# only reach published days are kept this long (see `data.daily_mobility`)
+SETTLED_TTL = 30 * DAY
+
+# directory, inside the cache, of the layers stored by `set_layer`
+LAYERS_DIR = 'geolayers'
+
+
+class ResponseCache:
+    """On-disk cache of API responses.
+
+    Each response is stored in its own file, keyed by collection and request
+    parameters (where, projection, sort, page...). Entries expire after the
+    TTL of their collection, and the least recently used ones are evicted
+    when the cache grows over `max_size` bytes. With `refresh=True` cached
+    responses are ignored, but new ones are still stored.
+
+    Entries keep the ETag and Last-Modified headers of their response, so
+    expired entries can be revalidated with a conditional request instead
+    of being downloaded again. Entries are read with the JSON `decoder`
+    (see `get_decoder`).
+
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE, ttls=None, refresh=False, decoder='auto'):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.refresh = refresh
+        self.loads = get_decoder(decoder)
+        self._size = None
+        self._lock = threading.Lock()
+        self._root = self # keeps the size of the cache, shared by its views
+
+    def view(self, refresh=None, ttls=None):
+        """Return a cache over the same entries with a different `refresh`
+        or some different `ttls`.
+
+        """
+        view = copy.copy(self)
+        if refresh is not None:
+            view.refresh = refresh
+        if ttls:
+            view.ttls = {**self.ttls, **ttls}
+        return view
+
+    def _path(self, collection, params):
+        key = json.dumps([collection, sorted((k, str(v)) for k, v in params.items())])
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, collection, digest + '.json')
+
+    def get(self, collection, params):
+        """Return the cached entry (a dict with the response, its validators
+        and the time it was stored) or None. The entry may be expired, check
+        it with `is_fresh`.
+
+        """
+        if self.refresh:
+            return None
+        path = self._path(collection, params)
+        try:
+            with open(path, 'rb') as f:
+                entry = self.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, collection, entry):
+        # an entry stored with a shorter TTL, e.g. before all of its days
+        # were published, keeps it
+        ttls = [ttl for ttl in [self.ttls.get(collection, DEFAULT_TTL), entry.get('ttl')] if ttl is not None]
+        return not ttls or time.time() - entry['stored_at'] <= min(ttls)
+
+    def set(self, collection, params, response, etag=None, last_modified=None):
+        path = self._path(collection, params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        entry = {'stored_at': time.time(), 'ttl': self.ttls.get(collection, DEFAULT_TTL), 'etag': etag, 'last_modified': last_modified, 'response': response}
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        size = os.path.getsize(tmp_path)
+        root = self._root
+        with root._lock:
+            # an entry revalidated or refreshed replaces the previous one
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+            if root._size is None:
+                root._size = sum(size for _, _, size in root._entries())
+            else:
+                root._size += size - replaced_size
+            if root._size > root.max_size:
+                root._evict()
+
+    def layer_path(self, layer, version, suffix='.json'):
+        """Path of the files of a version of a layer, e.g. its geometry or
+        derived files. Each version of a layer gets its own paths.
+
+        """
+        return os.path.join(self.cache_dir, LAYERS_DIR, self._layer_prefix(layer, version) + suffix)
+
+    def _layer_prefix(self, layer, version):
+        digest = hashlib.sha256(f'{layer}|{version}'.encode('utf-8')).hexdigest()[:16]
+        return f'{layer}.{digest}'
+
+    def get_layer(self, layer, version, suffix='.json'):
+        """Return the FeatureCollection of `layer` stored for `version`, or
+        None.
+
+        """
+        if self.refresh:
+            return None
+        path = self.layer_path(layer, version, suffix)
+        try:
+            with open(path, 'rb') as f:
+                featureCollection = self.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except OSError:
+            pass
+        return featureCollection
+
+    def set_layer(self, layer, version, featureCollection, suffix='.json'):
+        path = self.layer_path(layer, version, suffix)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # other versions of the layer, and their derived files, are outdated
+        prefix = self._layer_prefix(layer, version)
+        for filename in os.listdir(directory):
+            if filename.startswith(f'{layer}.') and not filename.startswith(prefix):
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except FileNotFoundError:
+                    pass
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(featureCollection, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        root = self._root
+        with root._lock:
+            for path, _, _ in root._entries():
+                os.remove(path)
+            root._size = 0
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for collection in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, collection)
+            if not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: # removed by another process
+                    continue
+                entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _evict(self):
+        # remove the least recently used entries until the cache fits again
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
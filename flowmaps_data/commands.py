@@ -1,30 +1,46 @@
 import os
+import re
 import json
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dateutil.parser import parse
 from datetime import timedelta
 
-from .utils import fetch_first, fetch_all_pages, date_rfc1123, parse_date, tz, save_df
-from .data import geolayer, covid19, dataset, daily_mobility, population, zone_movements, risk
+from .utils import fetch_first, fetch_all_pages, date_rfc1123, parse_date, tz, save_df, shard_slice
+from .data import geolayer, covid19, dataset, daily_mobility, population, zone_movements, risk, _local_day
+from .schemas import get_schema, RISK_SCHEMA
+from .sync import sync_daily_mobility as _sync_daily_mobility
+from .parts import parse_shard, part_path, merge_parts
+from .geo import save_geolayer, GEOLAYER_FORMATS, GEOLAYER_EXTENSIONS, DEFAULT_PRECISION
+from .hourly import ingest_hourly_mobility, load_manifest, save_manifest, merge_manifests, aggregate_hourly_mobility, MAESTRA1_COLUMNS
 
 
-def list_layers():
+# the download commands write the data page by page, as it arrives
+DOWNLOAD_CHUNKSIZE = 1000
+
+
+def _split_columns(columns):
+    # --columns is given as a comma separated list
+    return columns.split(',') if columns else None
+
+
+def list_layers(client=None):
     print('Listing layers:')
     filters = {
         'storedIn': 'layers', 
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)
     for doc in data:
         print(f"{doc['keywords']['layer']}:  \t{doc['keywords']['layerDesc']}, {doc['numEntries']} polygons")
 
 
-def describe_layer(layer, provenance=False, plot=False):
+def describe_layer(layer, provenance=False, plot=False, simplify=None, client=None):
     print(f'Describing layer={layer}')
     filters = {
         'storedIn': 'layers',
         'keywords.layer': layer,
     }
-    doc = fetch_first('provenance', filters)
+    doc = fetch_first('provenance', filters, client=client)
     if not doc:
         print(f"No data for layer={layer}")
         return
@@ -36,20 +52,23 @@ def describe_layer(layer, provenance=False, plot=False):
         print(f"Full provenance: {json.dumps(doc, indent=4)}")
 
     if plot:
-        download_layer(layer, None, plot=True, no_save=True)
+        download_layer(layer, None, plot=True, no_save=True, simplify=simplify, client=client)
 
 
-def download_layer(layer, output_file, plot=False, no_save=False):
+def download_layer(layer, output_file, plot=False, no_save=False, output_format='geojson', precision=DEFAULT_PRECISION, simplify=None, max_workers=1, pagination='page', shard=None, client=None):
+    if output_format not in GEOLAYER_FORMATS:
+        raise Exception(f"Unrecognized output_format '{output_format}'. Choose one from: {', '.join(GEOLAYER_FORMATS)}")
     if output_file is None:
-        output_file = layer+'.geojson'
+        output_file = layer + GEOLAYER_EXTENSIONS[output_format]
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
 
     print(f'Dowloading layer {layer}')
-    featureCollection = geolayer(layer, print_url=True)
+    featureCollection = geolayer(layer, print_url=True, max_workers=max_workers, pagination=pagination, shard=shard, tolerance=simplify, client=client)
 
     if not no_save:
         print(f'Saving layer to file: {output_file}')
-        with open(output_file, 'w') as f:
-            json.dump(featureCollection, f, indent=2)
+        save_geolayer(featureCollection, output_file, output_format, precision=precision)
 
     if plot:
         try:
@@ -64,12 +83,12 @@ def download_layer(layer, output_file, plot=False, no_save=False):
             print(f"\n\n  WARN: {e}. \n  To use the --plot option you need to install the following packages: geopandas, descartes, matplotlib. \n  For example, use:  pip install geopandas descartes matplotlib")
 
 
-def list_covid19(only_ids=False):
+def list_covid19(only_ids=False, client=None):
     filters = {
         'storedIn': 'layers.data.consolidated',
         'keywords.type': 'covid19', 
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)
     if only_ids:
         for doc in data:
             print(doc['keywords']['ev'])
@@ -79,13 +98,13 @@ def list_covid19(only_ids=False):
             print(f"{doc['keywords']['ev']}\n\tDescription: {doc.get('processedFrom', [{}])[0].get('keywords', {}).get('evDesc')}\n\tNumber of entries: {doc['numEntries']}\n\tlayer: {doc['keywords']['layer']}\n")
 
 
-def describe_covid19(ev, provenance=False):
+def describe_covid19(ev, provenance=False, client=None):
     print(f'Describing consolidated ev={ev}')
     filters = {
         'storedIn': 'layers.data.consolidated',
         'keywords.ev': ev,
     }
-    prov = fetch_first('provenance', filters)
+    prov = fetch_first('provenance', filters, client=client)
     print(f"Description: {prov.get('processedFrom', [{}])[0].get('keywords', {}).get('evDesc')}")
     print(f"Original data url: {[x.get('from') for x in prov.get('processedFrom', [{}])[0].get('fetched', [{}])]}")
     print(f"Original data downloaded at: {prov.get('processedFrom', [{}])[0].get('storedAt')}")
@@ -96,28 +115,30 @@ def describe_covid19(ev, provenance=False):
         'field': 'date',
         'query': {'type': 'covid19', 'ev': ev},
     }
-    data = fetch_all_pages('distinct', filters, progress=False)
+    data = fetch_all_pages('distinct', filters, progress=False, client=client)
     print(f"Available dates: min={min(data)}, max={max(data)}")
 
-    example = fetch_first('layers.data.consolidated', {'type': 'covid19', 'ev': ev})
+    example = fetch_first('layers.data.consolidated', {'type': 'covid19', 'ev': ev}, client=client)
     print("Example document:\n"+json.dumps(example, indent=4))
 
     if provenance:
         print(f"Full provenance: {json.dumps(prov, indent=4)}")
 
 
-def download_covid19(ev, output_file, output_format='csv', start_date=None, end_date=None):
+def download_covid19(ev, output_file, output_format='csv', start_date=None, end_date=None, columns=None, max_workers=1, pagination='page', shard_by=None, shard=None, client=None):
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
     print(f'Dowloading consolidated health data for ev={ev}')
-    df = covid19(ev, start_date=start_date, end_date=end_date, print_url=True)
-    save_df(df, output_file, output_format)
+    chunks = covid19(ev, start_date=start_date, end_date=end_date, print_url=True, columns=_split_columns(columns), max_workers=max_workers, pagination=pagination, chunksize=DOWNLOAD_CHUNKSIZE, shard_by=shard_by, shard=shard, client=client)
+    save_df(chunks, output_file, output_format, schema=get_schema('layers.data.consolidated', 'covid19'), partitions={'ev': ev})
 
 
-def list_data():
+def list_data(client=None):
     print('Listing ev:')
     filters = {
         'storedIn': 'layers.data',
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)
 
     # remove duplicates
     temp = {d["keywords"]["ev"]: d for d in data}
@@ -127,13 +148,13 @@ def list_data():
         print(f"{doc['keywords']['ev']}\n\tDescription: {doc['keywords'].get('evDesc', '')}\n\tlayer: {doc['keywords'].get('layer')}\n")
 
 
-def describe_data(ev, provenance=False):
+def describe_data(ev, provenance=False, client=None):
     print(f'Describing ev={ev}')
     filters = {
         'storedIn': 'layers.data',
         'keywords.ev': ev,
     }
-    prov = fetch_first('provenance', filters)
+    prov = fetch_first('provenance', filters, client=client)
     print(f"Description: {prov.get('keywords', {}).get('evDesc')}")
     print(f"Original data url: {[x.get('from') for x in prov.get('fetched', [{}])]}")
     print(f"Last downloaded at: {prov.get('storedAt')}")
@@ -144,27 +165,38 @@ def describe_data(ev, provenance=False):
         'field': 'evstart',
         'query': {'ev': ev},
     }
-    dates = fetch_all_pages('distinct', filters, progress=False)
+    dates = fetch_all_pages('distinct', filters, progress=False, client=client)
     dates = [parse(date) for date in dates]
     print(f"Available dates: min={min(dates)}, max={max(dates)}")
     if provenance:
         print(f"Full provenance: {json.dumps(prov, indent=4)}")
 
-    example = fetch_first('layers.data', {'ev': ev})
+    example = fetch_first('layers.data', {'ev': ev}, client=client)
     print("Example document:\n"+json.dumps(example, indent=4))
 
 
-def download_data(ev, output_file, output_format='csv', start_date=None, end_date=None):
+def _dataset_chunks(chunks, output_format):
+    # layers.data documents have no date, parquet datasets are partitioned by
+    # the local day of evstart instead
+    for chunk in chunks:
+        if output_format == 'parquet-dataset' and 'evstart' in chunk.columns and 'date' not in chunk.columns:
+            chunk = chunk.assign(date=_local_day(chunk['evstart']))
+        yield chunk
+
+
+def download_data(ev, output_file, output_format='csv', start_date=None, end_date=None, columns=None, max_workers=1, pagination='page', shard_by=None, shard=None, client=None):
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
     print(f'Dowloading data for ev={ev}')
-    df = dataset(ev, start_date=start_date, end_date=end_date, print_url=True)
-    save_df(df, output_file, output_format)
+    chunks = dataset(ev, start_date=start_date, end_date=end_date, print_url=True, columns=_split_columns(columns), max_workers=max_workers, pagination=pagination, chunksize=DOWNLOAD_CHUNKSIZE, shard_by=shard_by, shard=shard, client=client)
+    save_df(_dataset_chunks(chunks, output_format), output_file, output_format, schema={'date': 'date'}, partitions={'ev': ev})
 
 
-def list_hourly_mobility(only_urls=False):
+def list_hourly_mobility(only_urls=False, client=None):
     filters = {
         'storedIn': 'mitma_mov.movements_raw',
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)
     for doc in data:
         if only_urls:
             print(doc['fetched'][0]['from'])
@@ -172,22 +204,22 @@ def list_hourly_mobility(only_urls=False):
             print(f"{doc['keywords']['ev']}\n\tDescription: {doc['keywords'].get('evDesc', '')}\n\tlayer: {doc['keywords'].get('layer')}\n\tdate: {doc['keywords'].get('evday')}\n\turl: {doc['fetched'][0].get('from')}\n")
 
 
-def list_hourly_mobility_dates():
+def list_hourly_mobility_dates(client=None):
     filters = {
         'storedIn': 'mitma_mov.movements_raw',
         'numEntries': {'$gt': 0},
     }
-    prov = fetch_all_pages('provenance', filters, sort='keywords.evday', progress=False)
+    prov = fetch_all_pages('provenance', filters, sort='keywords.evday', progress=False, client=client)
     for doc in prov:
         print(parse(doc['keywords']['evday']).strftime('%Y-%m-%d'))
 
 
-def describe_hourly_mobility(date, only_url=False):
+def describe_hourly_mobility(date, only_url=False, client=None):
     filters = {
         'storedIn': 'mitma_mov.movements_raw',
         'keywords.evday': {'$gte': date_rfc1123(parse_date(date)), '$lt': date_rfc1123(parse_date(date) + timedelta(days=1))}
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)
     for doc in data:
         if only_url:
             print(doc['fetched'][0]['from'])
@@ -200,59 +232,140 @@ def describe_hourly_mobility(date, only_url=False):
             print(f"Full provenance: {json.dumps(data, indent=4)}")
 
 
-def _download_hourly_mobility(date, output_dir):
+def _hourly_mobility_urls(client=None):
+    # url of the hourly mobility file of each available date
     filters = {
         'storedIn': 'mitma_mov.movements_raw',
-        'keywords.evday': {'$gte': date_rfc1123(parse_date(date)), '$lt': date_rfc1123(parse_date(date) + timedelta(days=1))}
+        'numEntries': {'$gt': 0},
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
-    url = data[0]['fetched'][0]['from']
-    filename = f'mitma_mov-maestra1-{date}.parquet'
-    path = os.path.join(output_dir, filename)
-    dtypes = "{'fecha': str, 'origen': str, 'destino': str, 'actividad_origen': str, 'actividad_destino': str, 'residencia': int, 'edad': str, 'periodo': int, 'distancia': str, 'viajes': float, 'viajes_km': float}"
-    command = f'curl {url} | gunzip -c | python3 -c "import pandas, sys; df=pandas.read_csv(sys.stdin, sep=\'|\', dtype={dtypes}); df.to_parquet(\'{path}\')"'
-    print(f"Downloading and extracting data for date: {date}")
-    print(command)
-    os.system(command)
-    print('')
-
-
-def download_hourly_mobility(start_date, end_date, output_dir):
-    for date in pd.date_range(start_date, end_date):
-        date_str = date.strftime('%Y-%m-%d')
-        _download_hourly_mobility(date_str, output_dir)
-
-
-def list_daily_mobility():
+    prov = fetch_all_pages('provenance', filters, progress=False, client=client)
+    return {parse(doc['keywords']['evday']).astimezone(tz).strftime('%Y-%m-%d'): doc['fetched'][0]['from'] for doc in prov}
+
+
+def _parse_filter(text):
+    # --filter is given as <column><operator><value>, e.g. periodo>=7,
+    # origen^=28 (starts with) or distancia=002-005,005-010 (any of them)
+    match = re.match(r'^(\w+)(==|=|!=|>=|<=|>|<|\^=)(.+)$', text)
+    if not match or match.group(1) not in MAESTRA1_COLUMNS:
+        raise Exception(f"Unrecognized filter '{text}'. Use <column><operator><value>, with operator one of: = != < <= > >= ^=")
+    column, op, value = match.groups()
+    parse_value = {'int64': int, 'float64': float}.get(MAESTRA1_COLUMNS[column], str)
+    values = [parse_value(v) for v in value.split(',')]
+    if op == '^=':
+        return column, 'startswith', values
+    if op in ('=', '==') and len(values) > 1:
+        return column, 'in', values
+    return column, '==' if op == '=' else op, values[0]
+
+
+def download_hourly_mobility(start_date, end_date, output_dir, max_workers=1, columns=None, filters=None, sort_by=None, compression='zstd', shard=None, client=None):
+    # the files are downloaded and converted to parquet by a pool of
+    # processes, several days at a time. The manifest keeps track of the
+    # finished dates, so running it again only downloads what is missing.
+    options = {
+        'columns': _split_columns(columns),
+        'filters': [_parse_filter(f) for f in (filters or [])],
+        'sort_by': _split_columns(sort_by),
+        'compression': None if compression == 'none' else compression,
+    }
+    shard = parse_shard(shard)
+    urls = _hourly_mobility_urls(client=client)
+    manifest = load_manifest(output_dir, shard)
+    failed = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        dates = pd.date_range(start_date, end_date)
+        if shard:
+            dates = shard_slice(dates, shard)
+        for date in dates:
+            date_str = date.strftime('%Y-%m-%d')
+            if date_str not in urls:
+                print(f"No hourly mobility data for date: {date_str}, skipping")
+                continue
+            url = urls[date_str]
+            filename = f'mitma_mov-maestra1-{date_str}.parquet'
+            path = os.path.join(output_dir, filename)
+            entry = manifest.get(date_str, {})
+            # files converted with other options are converted again
+            same_options = entry.get('options') == json.loads(json.dumps(options))
+            if entry.get('state') == 'complete' and entry.get('url') == url and same_options and os.path.exists(path):
+                print(f"Already downloaded data for date: {date_str}, skipping")
+                continue
+            print(f"Downloading and extracting data for date: {date_str} from {url}")
+            manifest[date_str] = {'url': url, 'file': filename, 'options': options, 'state': 'downloading'}
+            futures[executor.submit(ingest_hourly_mobility, url, path, **options)] = (date_str, path)
+        save_manifest(output_dir, manifest, shard)
+
+        for future in as_completed(futures):
+            date_str, path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Error downloading data for date {date_str}: {e}")
+                manifest[date_str]['state'] = 'failed'
+                failed.append(date_str)
+            else:
+                manifest[date_str].update(size=result['size'], checksum=result['checksum'], validator=result['validator'], state='complete')
+                print(f"{result['num_rows']} rows written to file:", path)
+            save_manifest(output_dir, manifest, shard)
+    if failed:
+        raise Exception(f"Failed to download hourly mobility for dates: {', '.join(sorted(failed))}")
+
+
+def _parse_periodos(periodos):
+    # --periodos is given as a comma separated list of hours or ranges of hours, e.g. 7-9,18
+    if not periodos:
+        return None
+    hours = []
+    for item in periodos.split(','):
+        start, _, end = item.partition('-')
+        hours.extend(range(int(start), int(end or start) + 1))
+    return hours
+
+
+def aggregate_hourly_mobility_files(input_dir, output_file, output_format='csv', start_date=None, end_date=None, periodos=None, distancias=None, mapping_file=None, max_workers=1, client=None):
+    mapping = None
+    if mapping_file:
+        # two columns: the MITMA district id and the zone of the target layer
+        mapping_df = pd.read_csv(mapping_file, dtype=str)
+        mapping = dict(zip(mapping_df.iloc[:, 0], mapping_df.iloc[:, 1]))
+    print(f'Aggregating hourly mobility files in {input_dir}')
+    df = aggregate_hourly_mobility(input_dir, start_date=start_date, end_date=end_date,
+                                   periodos=_parse_periodos(periodos), distancias=_split_columns(distancias),
+                                   mapping=mapping, max_workers=max_workers)
+    save_df(df, output_file, output_format, schema=get_schema('mitma_mov.daily_mobility_matrix'))
+
+
+def list_daily_mobility(client=None):
     print('Listing available mobility layers:')
     filters = {
         'storedIn': 'mitma_mov.daily_mobility_matrix', 
         'keywords.layer_pairs': {'$ne': None},
     }
-    data = fetch_all_pages('provenance', filters, progress=False)[0]
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)[0]
     pairs = data['keywords']['layer_pairs']
     for source_layer, target_layer in pairs:
         print(json.dumps({"source_layer": source_layer, "target_layer": target_layer}))
 
 
-def list_daily_mobility_dates():
+def list_daily_mobility_dates(client=None):
     filters = {
         'storedIn': 'mitma_mov.daily_mobility_matrix',
         'numEntries': {'$gt': 0},
     }
-    prov = fetch_all_pages('provenance', filters, sort='keywords.date', progress=False)
+    prov = fetch_all_pages('provenance', filters, sort='keywords.date', progress=False, client=client)
     for doc in prov:
         print(doc['keywords']['date'])
 
 
-def describe_daily_mobility(provenance=False):
+def describe_daily_mobility(provenance=False, client=None):
     print(f'Describing daily mobility matrix')
     print(f"Description: Daily Origin-Destination matrix, based on anonymized mobile phone records from MITMA dataset (https://www.mitma.gob.es/ministerio/covid-19/evolucion-movilidad-big-data).")
     filters = {
         'storedIn': 'mitma_mov.daily_mobility_matrix',
         'numEntries': {'$gt': 0},
     }
-    prov = fetch_all_pages('provenance', filters, sort='keywords.date', progress=False)
+    prov = fetch_all_pages('provenance', filters, sort='keywords.date', progress=False, client=client)
     print(f"Original data url: {[x.get('from') for x in prov[-1].get('processedFrom', [{}])[0].get('fetched', [{}])]}")
     print(f"Original data downloaded at: {prov[-1].get('processedFrom', [{}])[0].get('storedAt')}")
     print(f"Processed at: {prov[-1]['storedAt']}")
@@ -261,37 +374,45 @@ def describe_daily_mobility(provenance=False):
     if provenance:
         print(f"Full provenance: {json.dumps(prov, indent=4)}")
     
-    example = fetch_first('mitma_mov.daily_mobility_matrix', {'source_layer': 'cnig_provincias', 'target_layer': 'cnig_provincias'})
+    example = fetch_first('mitma_mov.daily_mobility_matrix', {'source_layer': 'cnig_provincias', 'target_layer': 'cnig_provincias'}, client=client)
     print("Example document:\n"+json.dumps(example, indent=4))
 
 
-def download_daily_mobility(source_layer, target_layer, output_file, start_date=None, end_date=None, output_format='csv', source=None, target=None):
+def download_daily_mobility(source_layer, target_layer, output_file, start_date=None, end_date=None, output_format='csv', source=None, target=None, columns=None, max_workers=1, pagination='page', shard_by=None, shard=None, client=None):
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
     print(f'Dowloading mobility matrix for source_layer={source_layer} target_layer={target_layer}')
-    df = daily_mobility(source_layer, target_layer, 
+    chunks = daily_mobility(source_layer, target_layer, 
                         start_date=start_date, end_date=end_date, 
                         source=source, target=target,
-                        print_url=True)
-    save_df(df, output_file, output_format)
+                        print_url=True, columns=_split_columns(columns), max_workers=max_workers, pagination=pagination,
+                        chunksize=DOWNLOAD_CHUNKSIZE, shard_by=shard_by, shard=shard, client=client)
+    save_df(chunks, output_file, output_format, schema=get_schema('mitma_mov.daily_mobility_matrix'), partitions={'source_layer': source_layer, 'target_layer': target_layer})
+
+
+def sync_daily_mobility(source_layer, target_layer, store_dir, start_date=None, end_date=None, max_workers=4, client=None):
+    synced = _sync_daily_mobility(source_layer, target_layer, store_dir, start_date=start_date, end_date=end_date, max_workers=max_workers, client=client)
+    print(f'{len(synced)} dates synced to:', store_dir)
 
 
-def list_population_layers():
+def list_population_layers(client=None):
     print('Listing available population layers:')
     filters = {
         'collection': 'layers.data.consolidated', 
         'field': 'layer',
         'query': {'type': 'population'},
     }
-    data = fetch_all_pages('distinct', filters)
+    data = fetch_all_pages('distinct', filters, client=client)
     print("\n".join(data))
 
 
-def describe_population(layer, provenance=False):
+def describe_population(layer, provenance=False, client=None):
     print(f'Describing population data for layer={layer}')
     filters = {
         'storedIn': 'layers.data.consolidated',
         'keywords.layer': layer,
     }
-    prov = fetch_first('provenance', filters)
+    prov = fetch_first('provenance', filters, client=client)
     print(f"Description: population calculated based on anonymized mobile phone records from MITMA dataset (https://www.mitma.gob.es/ministerio/covid-19/evolucion-movilidad-big-data).")
     print(f"Original data url: {[x.get('from') for x in prov.get('processedFrom', [{}])[0].get('fetched', [{}])]}")
     print(f"Original data downloaded at: {prov.get('processedFrom', [{}])[0].get('storedAt')}")
@@ -302,42 +423,44 @@ def describe_population(layer, provenance=False):
         'field': 'date',
         'query': {'type': 'population', 'layer': layer},
     }
-    data = fetch_all_pages('distinct', filters, progress=False)
+    data = fetch_all_pages('distinct', filters, progress=False, client=client)
     print(f"Available dates: min={min(data)}, max={max(data)}")
 
-    example = fetch_first('layers.data.consolidated', {'type': 'population', 'layer': layer})
+    example = fetch_first('layers.data.consolidated', {'type': 'population', 'layer': layer}, client=client)
     print("Example document:\n"+json.dumps(example, indent=4))
 
     if provenance:
         print(f"Full provenance: {json.dumps(prov, indent=4)}")
 
 
-def download_population(layer, output_file, output_format='csv', start_date=None, end_date=None):
+def download_population(layer, output_file, output_format='csv', start_date=None, end_date=None, columns=None, max_workers=1, pagination='page', shard_by=None, shard=None, client=None):
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
     print(f'Dowloading population for layer={layer}')
-    df = population(layer, start_date=start_date, end_date=end_date, print_url=True)
-    save_df(df, output_file, output_format)
+    chunks = population(layer, start_date=start_date, end_date=end_date, print_url=True, columns=_split_columns(columns), max_workers=max_workers, pagination=pagination, chunksize=DOWNLOAD_CHUNKSIZE, shard_by=shard_by, shard=shard, client=client)
+    save_df(chunks, output_file, output_format, schema=get_schema('layers.data.consolidated', 'population'), partitions={'layer': layer})
 
 
-def list_zone_movements():
+def list_zone_movements(client=None):
     print('Listing available zone_movements layers:')
     filters = {
         'collection': 'layers.data.consolidated', 
         'field': 'layer',
         'query': {'type': 'zone_movements'},
     }
-    data = fetch_all_pages('distinct', filters)
+    data = fetch_all_pages('distinct', filters, client=client)
     data.insert(0, "mitma_mov") # mitma_mov layer is always available to download from its own collection
     print("\n".join(data))
 
 
-def describe_zone_movements(provenance=False):
+def describe_zone_movements(provenance=False, client=None):
     print(f'Describing zone_movements')
     filters = {
         'storedIn': 'layers.data.consolidated',
         'keywords.type': 'zone_movements',
         'numEntries': {'$gt': 0},
     }
-    provs = fetch_all_pages('provenance', filters, sort='keywords.date', progress=False)
+    provs = fetch_all_pages('provenance', filters, sort='keywords.date', progress=False, client=client)
     prov = provs[-1]
 
     print(f"Description: mobility data from MITMA dataset (https://www.mitma.gob.es/ministerio/covid-19/evolucion-movilidad-big-data), aggregated at different layers. Original data is based on anonymized mobile phone records. It contains the number of people in each geographical area that has done 0,1,2,3+ trips. NOTE: 3 or more trips are encoded as '-1'.")
@@ -350,35 +473,41 @@ def describe_zone_movements(provenance=False):
         'field': 'date',
         'query': {'type': 'zone_movements'},
     }
-    data = fetch_all_pages('distinct', filters, progress=False)
+    data = fetch_all_pages('distinct', filters, progress=False, client=client)
     print(f"Available dates: min={min(data)}, max={max(data)}")
 
-    example = fetch_first('layers.data.consolidated', {'type': 'zone_movements'})
+    example = fetch_first('layers.data.consolidated', {'type': 'zone_movements'}, client=client)
     print("Example document:\n"+json.dumps(example, indent=4))
 
     if provenance:
         print(f"Full provenance: {json.dumps(provs, indent=4)}")
 
 
-def download_zone_movements(layer, output_file, output_format='csv', start_date=None, end_date=None):
+def download_zone_movements(layer, output_file, output_format='csv', start_date=None, end_date=None, columns=None, max_workers=1, pagination='page', shard_by=None, shard=None, client=None):
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
     print(f'Dowloading population for layer={layer}')
-    df = zone_movements(layer, start_date=start_date, end_date=end_date, print_url=True)
-    save_df(df, output_file, output_format)
+    chunks = zone_movements(layer, start_date=start_date, end_date=end_date, print_url=True, columns=_split_columns(columns), max_workers=max_workers, pagination=pagination, chunksize=DOWNLOAD_CHUNKSIZE, shard_by=shard_by, shard=shard, client=client)
+    if layer == 'mitma_mov':
+        schema = get_schema('mitma_mov.zone_movements')
+    else:
+        schema = get_schema('layers.data.consolidated', 'zone_movements')
+    save_df(chunks, output_file, output_format, schema=schema, partitions={'layer': layer})
 
 
-def list_risk():
+def list_risk(client=None):
     filters = {
         'storedIn': 'mitma_mov.daily_mobility_matrix', 
         'keywords.layer_pairs': {'$ne': None},
     }
-    data = fetch_all_pages('provenance', filters, progress=False)[0]
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)[0]
     pairs = data['keywords']['layer_pairs']
 
     filters = {
         'storedIn': 'layers.data.consolidated',
         'keywords.type': 'covid19', 
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)
     print('Risk available for the following combinations of source layer, target layer and covid19 dataset:')
     for doc in data:
         ev = doc['keywords']['ev']
@@ -388,12 +517,12 @@ def list_risk():
                 print(json.dumps({'source_layer': pair[0], 'target_layer': pair[1], 'ev': ev}))
 
 
-def list_risk_dates(ev):
+def list_risk_dates(ev, client=None):
     filters = {
         'storedIn': 'mitma_mov.daily_mobility_matrix',
         'numEntries': {'$gt': 0},
     }
-    docs = fetch_all_pages('provenance', filters, sort='keywords.evday', progress=False)
+    docs = fetch_all_pages('provenance', filters, sort='keywords.evday', progress=False, client=client)
     mobility_dates = [doc['keywords']['date'] for doc in docs]
 
     filters = {
@@ -401,25 +530,30 @@ def list_risk_dates(ev):
         'field': 'date',
         'query': {'type': 'covid19', 'ev': ev},
     }
-    covid_dates = fetch_all_pages('distinct', filters, progress=False)
+    covid_dates = fetch_all_pages('distinct', filters, progress=False, client=client)
     
     dates = sorted(set(mobility_dates).intersection(covid_dates))
     print('\n'.join(dates))
 
 
-def download_risk(source_layer, target_layer, ev, date, output_file, output_format='csv'):
+def download_risk(source_layer, target_layer, ev, output_file, date=None, start_date=None, end_date=None, output_format='csv', max_workers=1, pagination='page', shard=None, client=None):
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
     print(f'Dowloading risk for source_layer={source_layer}, target_layer={target_layer}')
-    df = risk(source_layer, target_layer, ev, date)
-    save_df(df, output_file, output_format)
+    # several target layers can be given, separated by commas
+    target_layers = target_layer.split(',')
+    target_layer = target_layers if len(target_layers) > 1 else target_layer
+    df = risk(source_layer, target_layer, ev, date, max_workers=max_workers, pagination=pagination, shard=shard, start_date=start_date, end_date=end_date, client=client)
+    save_df(df, output_file, output_format, schema=RISK_SCHEMA)
 
 
-def list_deceased():
+def list_deceased(client=None):
     print("List of datasets that include deceased data:\n")
 
     filters = {
         'storedIn': 'layers.data',
     }
-    data = fetch_all_pages('provenance', filters, progress=False)
+    data = fetch_all_pages('provenance', filters, progress=False, client=client)
     
     # remove duplicates
     temp = {d["keywords"]["ev"]: d for d in data}
@@ -432,11 +566,23 @@ def list_deceased():
             print(f"{doc['keywords']['ev']}\n\tDescription: {doc['keywords'].get('evDesc', '')}\n\tlayer: {doc['keywords'].get('layer')}\n")
 
 
-def describe_deceased(ev, provenance=False):
-    return describe_data(ev, provenance=provenance)
+def describe_deceased(ev, provenance=False, client=None):
+    return describe_data(ev, provenance=provenance, client=client)
 
 
-def download_deceased(ev, output_file, output_format='csv', start_date=None, end_date=None):
+def download_deceased(ev, output_file, output_format='csv', start_date=None, end_date=None, columns=None, max_workers=1, pagination='page', shard_by=None, shard=None, client=None):
+    shard = parse_shard(shard)
+    output_file = part_path(output_file, shard)
     print(f'Dowloading data for ev={ev}')
-    df = dataset(ev, start_date=start_date, end_date=end_date, print_url=True)
-    save_df(df, output_file, output_format)
+    chunks = dataset(ev, start_date=start_date, end_date=end_date, print_url=True, columns=_split_columns(columns), max_workers=max_workers, pagination=pagination, chunksize=DOWNLOAD_CHUNKSIZE, shard_by=shard_by, shard=shard, client=client)
+    save_df(_dataset_chunks(chunks, output_format), output_file, output_format, schema={'date': 'date'}, partitions={'ev': ev})
+
+
+def merge(output_file=None, output_format='csv', output_dir=None, keep_parts=False, client=None):
+    # combine the parts written by the shards (--shard i/N) of a download
+    if output_dir:
+        merge_manifests(output_dir) # hourly mobility files are not split, only their manifest
+    elif output_file:
+        merge_parts(output_file, output_format, keep_parts=keep_parts)
+    else:
+        print('Use --output-file (and --output-format) of the download, or --output-dir for hourly_mobility')
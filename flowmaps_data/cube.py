@@ -0,0 +1,239 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from .utils import fetch_all_pages
+from .data import daily_mobility, _geolayer_query
+
+
+CUBE_FILE = 'cube.json'
+CUBE_ARRAYS = ['indptr', 'indices', 'data']
+
+
+def layer_zones(layer, client=None):
+    """Return the ids of the zones of `layer`, in the same order as the
+    features returned by `geolayer(layer)`.
+
+    """
+    collection, filters, _ = _geolayer_query(layer)
+    data = fetch_all_pages(collection, filters, projection={'id': 1}, progress=False, client=client)
+    if not data:
+        raise Exception(f"Missing layer: {layer}")
+    return [doc['id'] for doc in data]
+
+
+class MobilityCube:
+    """Daily origin-destination matrices, stored as a single CSR sparse
+    matrix with one row per (date, source) and one column per target.
+
+    Zones are kept as integer indices into `source_zones` and
+    `target_zones` (aligned with the features of their layers when built
+    from the API), so only the non-zero trips take memory. `save` writes
+    the arrays as .npy files, which `open` maps into memory without
+    reading them.
+
+    """
+
+    def __init__(self, source_zones, target_zones, dates, indptr, indices, data, source_layer=None, target_layer=None):
+        self.source_zones = list(source_zones)
+        self.target_zones = list(target_zones)
+        self.dates = np.asarray(dates, dtype='datetime64[D]')
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.source_layer = source_layer
+        self.target_layer = target_layer
+        self._source_index = {zone: i for i, zone in enumerate(self.source_zones)}
+        self._target_index = {zone: i for i, zone in enumerate(self.target_zones)}
+
+    def __repr__(self):
+        return f'<MobilityCube {self.source_layer}->{self.target_layer} dates={len(self.dates)} sources={len(self.source_zones)} targets={len(self.target_zones)} nnz={self.nnz}>'
+
+    @property
+    def shape(self):
+        return len(self.dates), len(self.source_zones), len(self.target_zones)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @classmethod
+    def from_frame(cls, df, source_zones=None, target_zones=None, source_layer=None, target_layer=None):
+        """Build a cube from a DataFrame with source, target, date and trips
+        columns, like the ones returned by `daily_mobility`. Rows with zones
+        missing from `source_zones` or `target_zones` (by default, all the
+        zones in `df`) are left out.
+
+        """
+        if source_zones is None:
+            source_zones = sorted(df['source'].astype(str).unique())
+        if target_zones is None:
+            target_zones = sorted(df['target'].astype(str).unique())
+        sources = pd.Categorical(df['source'].astype(str), categories=source_zones).codes
+        targets = pd.Categorical(df['target'].astype(str), categories=target_zones).codes
+        days = pd.to_datetime(df['date']).to_numpy().astype('datetime64[D]')
+        dates = np.unique(days)
+
+        known = (sources >= 0) & (targets >= 0)
+        if not known.all():
+            print(f'{np.count_nonzero(~known)} rows with zones outside of the cube were left out')
+        num_sources, num_targets = len(source_zones), len(target_zones)
+        rows = np.searchsorted(dates, days[known]).astype(np.int64) * num_sources + sources[known]
+        columns = targets[known].astype(np.int64)
+        trips = df['trips'].to_numpy(dtype=np.float32, na_value=0)[known]
+
+        # one entry per (row, column), repeated pairs are added up
+        keys, inverse = np.unique(rows * num_targets + columns, return_inverse=True)
+        data = np.bincount(inverse, weights=trips, minlength=len(keys)).astype(np.float32)
+        counts = np.bincount(keys // num_targets, minlength=len(dates) * num_sources)
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        indices = (keys % num_targets).astype(np.int32)
+        return cls(source_zones, target_zones, dates, indptr, indices, data, source_layer, target_layer)
+
+    @classmethod
+    def from_daily_mobility(cls, source_layer, target_layer, start_date=None, end_date=None, align=True, max_workers=1, shard_by=None, client=None):
+        """Download the daily mobility between two layers into a cube. With
+        `align`, zones are indexed in the order of the features of each
+        layer, so they line up with `geolayer`.
+
+        """
+        df = daily_mobility(source_layer, target_layer, start_date=start_date, end_date=end_date, max_workers=max_workers, shard_by=shard_by, client=client)
+        if df.empty:
+            raise Exception(f'Missing mobility data for source_layer={source_layer} target_layer={target_layer}')
+        source_zones = target_zones = None
+        if align:
+            source_zones = layer_zones(source_layer, client=client)
+            target_zones = source_zones if target_layer == source_layer else layer_zones(target_layer, client=client)
+        return cls.from_frame(df, source_zones, target_zones, source_layer, target_layer)
+
+    @classmethod
+    def from_parquet(cls, path, source_layer=None, target_layer=None, start_date=None, end_date=None, source_zones=None, target_zones=None):
+        """Build a cube from a local Parquet file or dataset, as written by
+        `download --output-format parquet`, `sync_daily_mobility` or
+        `aggregate_hourly_mobility`. Only the columns and dates needed are
+        read. `source_layer` and `target_layer` select a pair of layers in
+        datasets that hold several of them.
+
+        """
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        expression = None
+        for column, value in [('source_layer', source_layer), ('target_layer', target_layer)]:
+            if value is not None and column in dataset.schema.names:
+                condition = ds.field(column) == value
+                expression = condition if expression is None else expression & condition
+        table = dataset.to_table(columns=['source', 'target', 'date', 'trips'], filter=expression)
+        df = table.to_pandas()
+        # the date is a string in partitioned datasets and a date elsewhere
+        df['date'] = pd.to_datetime(df['date'].astype(str))
+        if start_date:
+            df = df[df['date'] >= start_date]
+        if end_date:
+            df = df[df['date'] <= end_date]
+        return cls.from_frame(df, source_zones, target_zones, source_layer, target_layer)
+
+    def save(self, path):
+        """Write the cube into the directory `path`."""
+        os.makedirs(path, exist_ok=True)
+        for name in CUBE_ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), np.asarray(getattr(self, name)))
+        meta = {
+            'source_layer': self.source_layer,
+            'target_layer': self.target_layer,
+            'source_zones': self.source_zones,
+            'target_zones': self.target_zones,
+            'dates': [str(date) for date in self.dates],
+        }
+        # written last, a directory without it holds no complete cube
+        tmp_path = os.path.join(path, f'{CUBE_FILE}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(path, CUBE_FILE))
+
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        """Open a cube written by `save`. Its arrays are memory-mapped, only
+        the parts that are used are read from disk.
+
+        """
+        with open(os.path.join(path, CUBE_FILE)) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode) for name in CUBE_ARRAYS}
+        return cls(meta['source_zones'], meta['target_zones'], meta['dates'], source_layer=meta['source_layer'], target_layer=meta['target_layer'], **arrays)
+
+    def _date_range(self, start_date=None, end_date=None):
+        start = 0 if start_date is None else np.searchsorted(self.dates, np.datetime64(start_date, 'D'), side='left')
+        end = len(self.dates) if end_date is None else np.searchsorted(self.dates, np.datetime64(end_date, 'D'), side='right')
+        return int(start), int(end)
+
+    def _date_position(self, date):
+        start, end = self._date_range(date, date)
+        if start == end:
+            raise Exception(f'Date {date} not in cube')
+        return start
+
+    def day(self, date):
+        """Return the (indptr, indices, data) arrays of the CSR matrix of
+        `date`. indices and data are views of the cube arrays.
+
+        """
+        num_sources = len(self.source_zones)
+        row = self._date_position(date) * num_sources
+        indptr = np.asarray(self.indptr[row:row + num_sources + 1])
+        start, end = indptr[0], indptr[-1]
+        return indptr - start, self.indices[start:end], self.data[start:end]
+
+    def matrix(self, date, dense=False):
+        """Origin-destination matrix of `date`, as a scipy.sparse CSR matrix
+        or, with `dense`, as a 2D numpy array.
+
+        """
+        indptr, indices, data = self.day(date)
+        shape = (len(self.source_zones), len(self.target_zones))
+        if dense:
+            matrix = np.zeros(shape, dtype=np.float32)
+            matrix[np.repeat(np.arange(shape[0]), np.diff(indptr)), indices] = data
+            return matrix
+        try:
+            import scipy.sparse
+        except ImportError as e:
+            raise ImportError(f"{e}. To get sparse matrices you need to install scipy, for example: pip install scipy")
+        return scipy.sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+    def to_frame(self, start_date=None, end_date=None, sources=None, targets=None):
+        """Return the trips between `start_date` and `end_date`, from
+        `sources` to `targets` (lists of zone ids, all by default), as a
+        long DataFrame like the ones returned by `daily_mobility`.
+
+        """
+        num_sources = len(self.source_zones)
+        start, end = self._date_range(start_date, end_date)
+        indptr = np.asarray(self.indptr[start * num_sources:end * num_sources + 1])
+        if not len(indptr) or indptr[0] == indptr[-1]:
+            rows = np.array([], dtype=np.int64)
+            indices = np.array([], dtype=np.int32)
+            data = np.array([], dtype=np.float32)
+        else:
+            rows = np.repeat(np.arange(start * num_sources, end * num_sources), np.diff(indptr))
+            indices = np.asarray(self.indices[indptr[0]:indptr[-1]])
+            data = np.asarray(self.data[indptr[0]:indptr[-1]])
+
+        mask = np.ones(len(rows), dtype=bool)
+        if sources is not None:
+            wanted = np.zeros(num_sources, dtype=bool)
+            wanted[[self._source_index[zone] for zone in sources if zone in self._source_index]] = True
+            mask &= wanted[rows % num_sources]
+        if targets is not None:
+            wanted = np.zeros(len(self.target_zones), dtype=bool)
+            wanted[[self._target_index[zone] for zone in targets if zone in self._target_index]] = True
+            mask &= wanted[indices]
+        rows, indices, data = rows[mask], indices[mask], data[mask]
+
+        return pd.DataFrame({
+            'source': pd.Categorical.from_codes(rows % num_sources, categories=self.source_zones),
+            'target': pd.Categorical.from_codes(indices, categories=self.target_zones),
+            'date': pd.to_datetime(self.dates[rows // num_sources]),
+            'trips': data,
+        })
@@ -1,15 +1,77 @@
 import pandas as pd
 from datetime import datetime, timedelta
 
-from .utils import fetch_first, fetch_all_pages, parse_date, date_rfc1123, tz
+from .utils import get_client, fetch_first, fetch_all_pages, iter_pages, iter_chunks, iter_shards, date_shards, shard_slice, parse_date, date_rfc1123, tz
+from .cache import SETTLED_TTL
+from .schemas import get_schema, frame_from_docs, concat_frames
+from .geo import simplify_geolayer, simplify_levels, simplified_suffix, zoom_tolerance, ZOOM_LEVELS
 
 
-def geolayer(layer, print_url=False):
+def _date_filter(start_date=None, end_date=None):
+    if start_date and end_date:
+        return {'$gte': start_date, '$lte': end_date}
+    elif start_date:
+        return {'$gte': start_date}
+    elif end_date:
+        return {'$lte': end_date}
+    return None
+
+
+def _evstart_filter(start_date=None, end_date=None):
+    if start_date and end_date:
+        return {'$gte': date_rfc1123(parse_date(start_date)), '$lt': date_rfc1123(parse_date(end_date) + timedelta(days=1))}
+    elif start_date:
+        return {'$gte': date_rfc1123(parse_date(start_date))}
+    elif end_date:
+        return {'$lt': date_rfc1123(parse_date(end_date) + timedelta(days=1))}
+    return None
+
+
+def _local_day(evstart):
+    # the local day of each evstart, as datetime64
+    return pd.to_datetime(evstart, utc=True).dt.tz_convert(tz).dt.tz_localize(None).dt.normalize()
+
+
+def _select(df, columns=None):
+    return df[columns] if columns else df
+
+
+def _fetch_result(collection, filters, build_result, chunksize=None, **kwargs):
+    # with chunksize, return a generator of results of chunksize documents
+    # instead of building one result from all the documents. Pages keep the
+    # page size of the client.
+    if chunksize:
+        pages = iter_pages(collection, filters, **kwargs)
+        return (build_result(chunk) for chunk in iter_chunks(pages, chunksize))
+    # otherwise each page is turned into columns as soon as it arrives, so
+    # the documents of only one page are kept in memory
+    frames = [build_result(page) for page in iter_pages(collection, filters, **kwargs) if page]
+    return concat_frames(frames) if frames else build_result([])
+
+
+def _fetch_sharded(build_query, start_date, end_date, shard_by, build_result, chunksize=None, shard=None, **kwargs):
+    # split the date range into one query per day or week, fetched
+    # concurrently. With chunksize, yield one result per shard. With shard,
+    # only its block of dates is fetched.
+    queries = [build_query(start, end) for start, end in date_shards(start_date, end_date, shard_by)]
+    if shard:
+        queries = shard_slice(queries, shard)
+    shards = iter_shards(queries, **kwargs)
+    if chunksize:
+        return (build_result(data) for data in shards if data)
+    frames = [build_result(data) for data in shards if data]
+    return concat_frames(frames) if frames else build_result([])
+
+
+def _geolayer_query(layer):
     filters = {
         'layer': layer
     }
-    data = fetch_all_pages('layers', filters, print_url=print_url)
+    projection = {'id': 1, 'centroid': 1, 'feat': 1}
+    return 'layers', filters, projection
 
+
+def _geolayer_result(data):
     featureCollection = {
         "type": "FeatureCollection",
         "features": [{
@@ -21,178 +83,354 @@ def geolayer(layer, print_url=False):
     return featureCollection
 
 
+def layer_version(layer, client=None):
+    """Return the time `layer` was stored in the API, from its provenance,
+    or None if unknown.
+
+    """
+    doc = fetch_first('provenance', {'storedIn': 'layers', 'keywords.layer': layer}, projection={'storedAt': 1}, client=client)
+    return doc.get('storedAt') if doc else None
+
+
+def geolayer(layer, print_url=False, max_workers=1, pagination='page', shard=None, tolerance=None, client=None):
+    """Return the zones of `layer` as a GeoJSON FeatureCollection. With
+    `tolerance`, their borders are simplified (see `simplify_levels`).
+
+    """
+    if tolerance and shard:
+        raise Exception('Layers can not be simplified by shards, shared borders need the whole layer')
+    # whole layers are kept in the cache of the client until a new version
+    # of the layer is stored in the API
+    cache = get_client(client).cache
+    version = layer_version(layer, client=client) if cache is not None and shard is None else None
+    if version is not None:
+        featureCollection = cache.get_layer(layer, version, simplified_suffix(tolerance))
+        if featureCollection is not None:
+            return featureCollection
+
+    featureCollection = cache.get_layer(layer, version) if version is not None and tolerance else None
+    if featureCollection is None:
+        collection, filters, projection = _geolayer_query(layer)
+        # the cached pages may be from an older version of the layer
+        fetch_client = get_client(client).with_cache(refresh=True) if version is not None else client
+        data = fetch_all_pages(collection, filters, projection=projection, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=fetch_client)
+        featureCollection = _geolayer_result(data)
+        if version is not None and featureCollection['features']:
+            cache.set_layer(layer, version, featureCollection)
+    if not tolerance:
+        return featureCollection
+    if version is None:
+        return simplify_geolayer(featureCollection, tolerance)
+
+    # the zoom levels of web maps are simplified at the same time, and
+    # cached for later
+    levels = simplify_levels(featureCollection, [tolerance] + [zoom_tolerance(zoom) for zoom in ZOOM_LEVELS])
+    for level_tolerance, simplified in levels.items():
+        cache.set_layer(layer, version, simplified, simplified_suffix(level_tolerance))
+    return levels[tolerance]
+
+
 def clean_docs(docs, drop_fields):
     for doc in docs:
         for field in drop_fields:
-            del(doc[field])
+            doc.pop(field, None) # may have been left out by the projection
     return docs
 
 
-def covid19(ev, start_date=None, end_date=None, print_url=False):
-    # fetch covid cases
+_COVID19_COLUMNS = [
+    "id", "date", "layer", "population", "new_cases", "total_cases",
+    "active_cases_7", "active_cases_14", "new_cases_mean_7", "new_cases_mean_14",
+    "active_cases_14_by_100k", "active_cases_7_by_100k", "new_cases_by_100k",
+    "total_cases_by_100k",
+]
+
+
+def _covid19_query(ev, start_date=None, end_date=None, columns=None):
     filters = {
         'ev': ev,
         'type': 'consolidated' # 'type': 'covid19',
     }
-    if start_date and end_date:
-        filters['date'] = {'$gte': start_date, '$lte': end_date}
-    elif start_date:
-        filters['date'] = {'$gte': start_date}
-    elif end_date:
-        filters['date'] = {'$lte': end_date}
+    date_filter = _date_filter(start_date, end_date)
+    if date_filter:
+        filters['date'] = date_filter
+    projection = {field: 1 for field in (columns or _COVID19_COLUMNS)}
+    return 'layers.data.consolidated', filters, projection
 
-    cursor = fetch_all_pages('layers.data.consolidated', filters, print_url=print_url)
+
+def _covid19_result(cursor, columns=None):
     # small fix to allowquerying fromtype consolidated which solves the problem with population NaN
     # cursor = clean_docs(cursor, ['d', 'c', 'updated_at', '_id', 'was_missing', 'type', 'ev'])
     cursor = clean_docs(cursor, ['_id', 'type', 'ev'])
-    df = pd.DataFrame(cursor)
-    columns = [ "id", "date", "layer", "population", "new_cases", "total_cases",
-                "active_cases_7", "active_cases_14", "new_cases_mean_7", "new_cases_mean_14",
-                "active_cases_14_by_100k", "active_cases_7_by_100k", "new_cases_by_100k",
-                "total_cases_by_100k"]
+    return frame_from_docs(cursor, get_schema('layers.data.consolidated', 'covid19'), columns or _COVID19_COLUMNS)
 
-    df = df[columns]
-    return df
 
+def covid19(ev, start_date=None, end_date=None, print_url=False, columns=None, max_workers=1, pagination='page', chunksize=None, shard_by=None, shard=None, client=None):
+    if shard_by:
+        return _fetch_sharded(lambda start, end: _covid19_query(ev, start, end, columns), start_date, end_date, shard_by, lambda page: _covid19_result(page, columns), chunksize=chunksize, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
+    # fetch covid cases
+    collection, filters, projection = _covid19_query(ev, start_date, end_date, columns)
+    return _fetch_result(collection, filters, lambda page: _covid19_result(page, columns), chunksize=chunksize, projection=projection, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
 
 
-def dataset(ev, start_date=None, end_date=None, print_url=False):
+def _dataset_query(ev, start_date=None, end_date=None, columns=None):
     filters = {
         'ev': ev,
     }
-    if start_date and end_date:
-        filters['evstart'] = {'$gte': date_rfc1123(parse_date(start_date)), '$lt': date_rfc1123(parse_date(end_date) + timedelta(days=1))}
-    elif start_date:
-        filters['evstart'] = {'$gte': date_rfc1123(parse_date(start_date))}
-    elif end_date:
-        filters['evstart'] = {'$lt': date_rfc1123(parse_date(end_date) + timedelta(days=1))}
-    data = fetch_all_pages('layers.data', filters, print_url=print_url)
-    return pd.DataFrame(data)
+    evstart_filter = _evstart_filter(start_date, end_date)
+    if evstart_filter:
+        filters['evstart'] = evstart_filter
+    projection = {field: 1 for field in (columns or [])}
+    return 'layers.data', filters, projection
+
+
+def _dataset_result(data, columns=None):
+    return _select(pd.DataFrame(data), columns)
+
+
+def dataset(ev, start_date=None, end_date=None, print_url=False, columns=None, max_workers=1, pagination='page', chunksize=None, shard_by=None, shard=None, client=None):
+    if shard_by:
+        return _fetch_sharded(lambda start, end: _dataset_query(ev, start, end, columns), start_date, end_date, shard_by, lambda page: _dataset_result(page, columns), chunksize=chunksize, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
+    collection, filters, projection = _dataset_query(ev, start_date, end_date, columns)
+    return _fetch_result(collection, filters, lambda page: _dataset_result(page, columns), chunksize=chunksize, projection=projection, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
+
+
+def latest_daily_mobility_date(client=None):
+    """Return the last date with daily mobility published in the API, from
+    the provenance of the matrices, or None if unknown.
+
+    """
+    filters = {
+        'storedIn': 'mitma_mov.daily_mobility_matrix',
+        'numEntries': {'$gt': 0},
+    }
+    doc = fetch_first('provenance', filters, projection={'keywords': 1}, sort='-keywords.date', client=client)
+    return doc.get('keywords', {}).get('date') if doc else None
+
+
+def _mobility_client(end_date, client=None):
+    # days of mobility do not change once published, the responses of
+    # queries that only reach published days are kept longer in the cache
+    client = get_client(client)
+    if client.cache is None or not end_date:
+        return client
+    latest = latest_daily_mobility_date(client=client)
+    if latest is None or end_date > latest:
+        return client
+    return client.with_cache(ttls={'mitma_mov.daily_mobility_matrix': SETTLED_TTL})
 
 
-def daily_mobility(source_layer, target_layer, start_date=None, end_date=None, source=None, target=None, print_url=False):
+def _daily_mobility_query(source_layer, target_layer, start_date=None, end_date=None, source=None, target=None, columns=None):
     filters = {
         'source_layer': source_layer,
         'target_layer': target_layer,
     }
-    if start_date and end_date:
-        filters['date'] = {'$gte': start_date, '$lte': end_date}
-    elif start_date:
-        filters['date'] = {'$gte': start_date}
-    elif end_date:
-        filters['date'] = {'$lte': end_date}
+    date_filter = _date_filter(start_date, end_date)
+    if date_filter:
+        filters['date'] = date_filter
     if source:
         filters['source'] = source
     if target:
         filters['target'] = target
-    data = fetch_all_pages('mitma_mov.daily_mobility_matrix', filters, print_url=print_url)
+    if columns:
+        projection = {field: 1 for field in columns}
+    else:
+        projection = {'source_layer': 0, 'target_layer': 0, 'updated_at': 0}
+    return 'mitma_mov.daily_mobility_matrix', filters, projection
+
+
+def _daily_mobility_result(data, columns=None):
     data = clean_docs(data, ['source_layer', 'target_layer', '_id', 'updated_at'])
-    return pd.DataFrame(data)
+    return frame_from_docs(data, get_schema('mitma_mov.daily_mobility_matrix'), columns)
+
 
+def daily_mobility(source_layer, target_layer, start_date=None, end_date=None, source=None, target=None, print_url=False, columns=None, max_workers=1, pagination='page', chunksize=None, shard_by=None, shard=None, client=None):
+    client = _mobility_client(end_date, client)
+    if shard_by:
+        return _fetch_sharded(lambda start, end: _daily_mobility_query(source_layer, target_layer, start, end, source, target, columns), start_date, end_date, shard_by, lambda page: _daily_mobility_result(page, columns), chunksize=chunksize, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
+    collection, filters, projection = _daily_mobility_query(source_layer, target_layer, start_date, end_date, source, target, columns)
+    return _fetch_result(collection, filters, lambda page: _daily_mobility_result(page, columns), chunksize=chunksize, projection=projection, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
 
-def population(layer, start_date=None, end_date=None, print_url=False):
+
+def _population_query(layer, start_date=None, end_date=None, columns=None):
     filters = {
         'layer': layer,
         'type': 'population',
     }
-    if start_date and end_date:
-        filters['date'] = {'$gte': start_date, '$lte': end_date}
-    elif start_date:
-        filters['date'] = {'$gte': start_date}
-    elif end_date:
-        filters['date'] = {'$lte': end_date}
-    data = fetch_all_pages('layers.data.consolidated', filters, print_url=print_url)
-    data = clean_docs(data, ['_id', 'type', 'layer', 'updated_at'])
-    return pd.DataFrame(data)
+    date_filter = _date_filter(start_date, end_date)
+    if date_filter:
+        filters['date'] = date_filter
+    if columns:
+        projection = {field: 1 for field in columns}
+    else:
+        projection = {'type': 0, 'layer': 0, 'updated_at': 0}
+    return 'layers.data.consolidated', filters, projection
 
 
-def _zone_movements_mitma_mov(start_date=None, end_date=None, print_url=False):
-    filters = {}
-    if start_date and end_date:
-        filters['evstart'] = {'$gte': date_rfc1123(parse_date(start_date)), '$lt': date_rfc1123(parse_date(end_date) + timedelta(days=1))}
-    elif start_date:
-        filters['evstart'] = {'$gte': date_rfc1123(parse_date(start_date))}
-    elif end_date:
-        filters['evstart'] = {'$lt': date_rfc1123(parse_date(end_date) + timedelta(days=1))}
-    data = fetch_all_pages('mitma_mov.zone_movements', filters, print_url=print_url)
-    df = pd.DataFrame(data)
+def _population_result(data, columns=None):
+    data = clean_docs(data, ['_id', 'type', 'layer', 'updated_at'])
+    return frame_from_docs(data, get_schema('layers.data.consolidated', 'population'), columns)
+
 
-    # add a date string column
-    df['evstart'] = pd.to_datetime(df['evstart'])
-    df['evstart'] = df['evstart'].dt.tz_convert(tz)
-    df['date'] = df['evstart'].dt.strftime('%Y-%m-%d')
+def population(layer, start_date=None, end_date=None, print_url=False, columns=None, max_workers=1, pagination='page', chunksize=None, shard_by=None, shard=None, client=None):
+    if shard_by:
+        return _fetch_sharded(lambda start, end: _population_query(layer, start, end, columns), start_date, end_date, shard_by, lambda page: _population_result(page, columns), chunksize=chunksize, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
+    collection, filters, projection = _population_query(layer, start_date, end_date, columns)
+    return _fetch_result(collection, filters, lambda page: _population_result(page, columns), chunksize=chunksize, projection=projection, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
 
-    # replace 'inf' with 3
-    df['viajes'] = df['viajes'].map(lambda x: 3 if x == float('inf') else x)
 
-    columns = ['id', 'date', 'viajes', 'personas']
-    return df[columns]
+_ZONE_MOVEMENTS_COLUMNS = ['id', 'date', 'viajes', 'personas']
 
 
-def zone_movements(layer, start_date=None, end_date=None, print_url=False):
+def _zone_movements_query(layer, start_date=None, end_date=None, columns=None):
+    columns = columns or _ZONE_MOVEMENTS_COLUMNS
     if layer == 'mitma_mov':
-        return _zone_movements_mitma_mov(start_date, end_date, print_url)
+        filters = {}
+        evstart_filter = _evstart_filter(start_date, end_date)
+        if evstart_filter:
+            filters['evstart'] = evstart_filter
+        # the date is computed from evstart
+        projection = {('evstart' if field == 'date' else field): 1 for field in columns}
+        return 'mitma_mov.zone_movements', filters, projection
 
     filters = {
         'layer': layer,
         'type': 'zone_movements',
     }
-    if start_date and end_date:
-        filters['date'] = {'$gte': start_date, '$lte': end_date}
-    elif start_date:
-        filters['date'] = {'$gte': start_date}
-    elif end_date:
-        filters['date'] = {'$lte': end_date}
-    data = fetch_all_pages('layers.data.consolidated', filters, print_url=print_url)
-    columns = ['id', 'date', 'viajes', 'personas']
-    df = pd.DataFrame(data)
-    df = df[columns]
-    return df
+    date_filter = _date_filter(start_date, end_date)
+    if date_filter:
+        filters['date'] = date_filter
+    projection = {field: 1 for field in columns}
+    return 'layers.data.consolidated', filters, projection
 
 
-def risk(source_layer, target_layer, ev, date):
-    filters = {
+def _zone_movements_result(layer, data, columns=None):
+    if layer != 'mitma_mov':
+        schema = get_schema('layers.data.consolidated', 'zone_movements')
+        return frame_from_docs(data, schema, columns or _ZONE_MOVEMENTS_COLUMNS)
+
+    for doc in data:
+        # replace 'inf' with 3
+        if doc.get('viajes') == float('inf'):
+            doc['viajes'] = 3
+    df = frame_from_docs(data, get_schema('mitma_mov.zone_movements'))
+
+    if 'evstart' in df.columns:
+        # add a date column, the local day of evstart
+        df['evstart'] = pd.to_datetime(df['evstart'])
+        df['evstart'] = df['evstart'].dt.tz_convert(tz)
+        df['date'] = _local_day(df['evstart'])
+
+    return df[columns or _ZONE_MOVEMENTS_COLUMNS]
+
+
+def zone_movements(layer, start_date=None, end_date=None, print_url=False, columns=None, max_workers=1, pagination='page', chunksize=None, shard_by=None, shard=None, client=None):
+    if shard_by:
+        return _fetch_sharded(lambda start, end: _zone_movements_query(layer, start, end, columns), start_date, end_date, shard_by, lambda page: _zone_movements_result(layer, page, columns), chunksize=chunksize, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
+    collection, filters, projection = _zone_movements_query(layer, start_date, end_date, columns)
+    return _fetch_result(collection, filters, lambda page: _zone_movements_result(layer, page, columns), chunksize=chunksize, projection=projection, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client)
+
+
+def _risk_queries(source_layer, target_layer, ev, start_date, end_date):
+    # target_layer may be a list of layers, all of them are fetched at once
+    date_filter = _date_filter(start_date, end_date)
+    mobility_filters = {
         'source_layer': source_layer,
-        'target_layer': target_layer,
-        'date': date
+        'target_layer': {'$in': list(target_layer)} if isinstance(target_layer, (list, tuple)) else target_layer,
+        'date': date_filter
     }
-    mobility = fetch_all_pages('mitma_mov.daily_mobility_matrix', filters, print_url=False)
-    if not mobility:
-        raise Exception(f'Missing mobility data matching: {filters}')
-    mobility = pd.DataFrame(mobility)
-    mobility = mobility[['source', 'target', 'source_layer', 'target_layer', 'trips']]
-
-    filters = {
+    cases_filters = {
         'type': 'covid19',
         'ev': ev,
-        'date': date
+        'date': date_filter
     }
-    cases = fetch_all_pages('layers.data.consolidated', filters, print_url=False)
-    if not cases:
-        raise Exception(f'Missing Covid19 data matching: {filters}')
-    cases = pd.DataFrame(cases)
-
-    df = pd.merge(mobility, cases, left_on='source', right_on='id', how='inner')
-
-    if 'population' not in cases.columns: 
-        filters = {
-            'type': 'population',
-            'layer': source_layer,
-            'date': date
-        }
-        population = fetch_all_pages('layers.data.consolidated', filters, print_url=False)
-        population = pd.DataFrame(population)
-        if not population:
-            raise Exception(f'Missing population data matching: {filters}')
-        df = pd.merge(df, population, left_on='source', right_on='id', how='inner')
+    # the population is published now and then, the last one published by
+    # each date is used, so it has no lower bound
+    population_filters = {
+        'type': 'population',
+        'layer': source_layer,
+    }
+    if end_date:
+        population_filters['date'] = _date_filter(None, end_date)
+    mobility_projection = {field: 1 for field in ['source', 'target', 'source_layer', 'target_layer', 'date', 'trips']}
+    cases_projection = {field: 1 for field in ['id', 'date', 'ev', 'population', 'active_cases_14', 'active_cases_7', 'new_cases']}
+    population_projection = {field: 1 for field in ['id', 'date', 'population']}
+    return {
+        'mobility': ('mitma_mov.daily_mobility_matrix', mobility_filters, mobility_projection),
+        'cases': ('layers.data.consolidated', cases_filters, cases_projection),
+        'population': ('layers.data.consolidated', population_filters, population_projection),
+    }
+
+
+def _same_categories(*columns):
+    # merging categoricals is only fast when they share their categories
+    categories = pd.api.types.union_categoricals([column for column in columns]).categories
+    return [column.cat.set_categories(categories) for column in columns]
+
+
+_RISK_COLUMNS = [
+    'source_layer', 'target_layer', 'date', 'source', 'target', 'trips', 'source_population',
+    'source_cases_last_14_days', 'source_cases_last_7_days', 'source_cases', 'ev',
+]
+
+
+def _risk_result(mobility, cases, population=None):
+    mobility = frame_from_docs(mobility, get_schema('mitma_mov.daily_mobility_matrix'), ['source', 'target', 'source_layer', 'target_layer', 'date', 'trips'])
+    cases = frame_from_docs(cases, get_schema('layers.data.consolidated', 'covid19'))
+    mobility['source'], cases['id'] = _same_categories(mobility['source'], cases['id'])
+
+    # all the dates at once, keyed by (date, source)
+    df = pd.merge(mobility, cases.rename(columns={'id': 'source'}), on=['date', 'source'], how='inner')
+
+    if 'population' not in cases.columns:
+        population = frame_from_docs(population, get_schema('layers.data.consolidated', 'population'), ['id', 'date', 'population'])
+        population = population.rename(columns={'id': 'source'}).dropna(subset=['population'])
+        df['source'], population['source'] = _same_categories(df['source'], population['source'])
+        # each date gets the last population of its zone published by then
+        df = pd.merge_asof(df.sort_values('date'), population.sort_values('date'), on='date', by='source', direction='backward')
+        df = df.dropna(subset=['population'])
 
     df = df.rename(columns={'population': 'source_population', 'active_cases_14': 'source_cases_last_14_days', 'active_cases_7': 'source_cases_last_7_days', 'new_cases': 'source_cases'})
-    df = df[['source_layer', 'target_layer', 'date', 'source', 'target', 'trips', 'source_population', 'source_cases_last_14_days', 'source_cases_last_7_days', 'source_cases', 'ev']]
+    df = df[_RISK_COLUMNS].sort_values(['date', 'target_layer', 'source', 'target'], ignore_index=True)
     df['source_cases_by_100k_last_14_days'] = 100000 * df['source_cases_last_14_days'] / df['source_population']
     df['risk'] = df['trips'] * df['source_cases_last_14_days'] / df['source_population']
     return df
 
 
-def deceased(ev, start_date=None, end_date=None, print_url=False):
+def risk(source_layer, target_layer, ev, date=None, max_workers=1, pagination='page', shard=None, start_date=None, end_date=None, client=None):
+    """Risk of importing cases through the mobility from `source_layer` to
+    `target_layer` (a layer or a list of layers), for one `date` or for all
+    the dates from `start_date` to `end_date`.
+
+    """
+    if date:
+        start_date = end_date = date
+    if not start_date and not end_date:
+        raise Exception('risk needs a date, or a start_date and end_date')
+    queries = _risk_queries(source_layer, target_layer, ev, start_date, end_date)
+
+    # with shard, only the mobility is split, every shard needs all the cases
+    collection, filters, projection = queries['mobility']
+    mobility = fetch_all_pages(collection, filters, projection=projection, print_url=False, max_workers=max_workers, pagination=pagination, shard=shard, client=_mobility_client(end_date, client))
+    if not mobility:
+        if shard:
+            return pd.DataFrame() # no mobility pages left for this shard
+        raise Exception(f'Missing mobility data matching: {filters}')
+
+    collection, filters, projection = queries['cases']
+    cases = fetch_all_pages(collection, filters, projection=projection, print_url=False, max_workers=max_workers, pagination=pagination, client=client)
+    if not cases:
+        raise Exception(f'Missing Covid19 data matching: {filters}')
+
+    population = None
+    if not any('population' in doc for doc in cases):
+        collection, filters, projection = queries['population']
+        population = fetch_all_pages(collection, filters, projection=projection, print_url=False, max_workers=max_workers, pagination=pagination, client=client)
+        if not population:
+            raise Exception(f'Missing population data matching: {filters}')
+
+    return _risk_result(mobility, cases, population)
+
+
+def deceased(ev, start_date=None, end_date=None, print_url=False, columns=None, max_workers=1, pagination='page', chunksize=None, shard_by=None, shard=None, client=None):
     # deceased datasets are no consolidated, so they can just be downloaded as any other dataset
-    return dataset(ev, start_date=start_date, end_date=end_date, print_url=print_url)
+    return dataset(ev, start_date=start_date, end_date=end_date, print_url=print_url, columns=columns, max_workers=max_workers, pagination=pagination, chunksize=chunksize, shard_by=shard_by, shard=shard, client=client)
@@ -0,0 +1,47 @@
+import json
+
+
+# in order of preference for 'auto'
+JSON_DECODERS = ['orjson', 'ujson', 'json']
+
+
+def _import_loads(name):
+    if name == 'orjson':
+        import orjson
+        return orjson.loads
+    if name == 'ujson':
+        import ujson
+        return ujson.loads
+    if name == 'json':
+        return json.loads
+    raise Exception(f"Unrecognized JSON decoder '{name}'. Choose one from: auto, {', '.join(JSON_DECODERS)}")
+
+
+def _with_fallback(loads):
+    def decode(data):
+        try:
+            return loads(data)
+        except ValueError:
+            # Infinity and NaN, which the API sends for some values, are
+            # only accepted by the json module
+            return json.loads(data)
+    return decode
+
+
+def get_decoder(name='auto'):
+    """Return a function that decodes JSON (from str or bytes) with the
+    library `name`: orjson, ujson or json (the standard library). 'auto'
+    uses the fastest one installed.
+
+    """
+    if name == 'auto':
+        for candidate in JSON_DECODERS:
+            try:
+                return get_decoder(candidate)
+            except ImportError:
+                continue
+    try:
+        loads = _import_loads(name)
+    except ImportError as e:
+        raise ImportError(f"{e}. To decode with {name} you need to install it, for example: pip install {name}")
+    return loads if name == 'json' else _with_fallback(loads)
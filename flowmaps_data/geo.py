@@ -0,0 +1,329 @@
+import json
+import struct
+import numpy as np
+
+
+GEOLAYER_FORMATS = ['geojson', 'geojson-compact', 'geoparquet', 'feather']
+
+GEOLAYER_EXTENSIONS = {
+    'geojson': '.geojson',
+    'geojson-compact': '.geojson',
+    'geoparquet': '.parquet',
+    'feather': '.feather',
+}
+
+# decimals kept by geojson-compact, 6 is about 10 cm
+DEFAULT_PRECISION = 6
+
+WKB_TYPES = {
+    'Point': 1,
+    'LineString': 2,
+    'Polygon': 3,
+    'MultiPoint': 4,
+    'MultiLineString': 5,
+    'MultiPolygon': 6,
+    'GeometryCollection': 7,
+}
+WKB_NAMES = {code: name for name, code in WKB_TYPES.items()}
+
+
+def _round_coordinates(coordinates, precision):
+    if not coordinates:
+        return coordinates
+    if isinstance(coordinates[0], (int, float)): # a position
+        return np.round(np.asarray(coordinates, dtype=float), precision).tolist()
+    if isinstance(coordinates[0][0], (int, float)): # a list of positions
+        return np.round(np.asarray(coordinates, dtype=float), precision).tolist()
+    return [_round_coordinates(part, precision) for part in coordinates]
+
+
+def _round_geometry(geometry, precision):
+    if geometry is None:
+        return None
+    if geometry['type'] == 'GeometryCollection':
+        return {**geometry, 'geometries': [_round_geometry(part, precision) for part in geometry['geometries']]}
+    return {**geometry, 'coordinates': _round_coordinates(geometry['coordinates'], precision)}
+
+
+def compact_geolayer(featureCollection, precision=DEFAULT_PRECISION):
+    """Return a copy of `featureCollection` with its coordinates (and
+    centroids) rounded to `precision` decimals.
+
+    """
+    features = []
+    for feature in featureCollection['features']:
+        feature = {**feature, 'geometry': _round_geometry(feature.get('geometry'), precision)}
+        if feature.get('centroid') is not None:
+            feature['centroid'] = _round_coordinates(feature['centroid'], precision)
+        features.append(feature)
+    return {**featureCollection, 'features': features}
+
+
+def _wkb_positions(positions):
+    # positions are written as 2D, little endian doubles
+    if not len(positions):
+        return struct.pack('<I', 0)
+    array = np.ascontiguousarray(np.asarray(positions, dtype='<f8')[:, :2])
+    return struct.pack('<I', len(array)) + array.tobytes()
+
+
+def to_wkb(geometry):
+    """Encode a GeoJSON geometry as (2D, little endian) WKB."""
+    kind = geometry['type']
+    if kind not in WKB_TYPES:
+        raise Exception(f"Unrecognized geometry type '{kind}'")
+    header = struct.pack('<BI', 1, WKB_TYPES[kind])
+    if kind == 'GeometryCollection':
+        parts = geometry['geometries']
+        return header + struct.pack('<I', len(parts)) + b''.join(to_wkb(part) for part in parts)
+    coordinates = geometry['coordinates']
+    if kind == 'Point':
+        return header + np.asarray(coordinates[:2], dtype='<f8').tobytes()
+    if kind == 'LineString':
+        return header + _wkb_positions(coordinates)
+    if kind == 'Polygon':
+        return header + struct.pack('<I', len(coordinates)) + b''.join(_wkb_positions(ring) for ring in coordinates)
+    part_type = kind[len('Multi'):]
+    return header + struct.pack('<I', len(coordinates)) + b''.join(to_wkb({'type': part_type, 'coordinates': part}) for part in coordinates)
+
+
+def _geo_metadata(table):
+    types = set()
+    for wkb in table.column('geometry').to_pylist():
+        if wkb is not None:
+            types.add(WKB_NAMES[struct.unpack('<I', wkb[1:5])[0]])
+    return {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {'encoding': 'WKB', 'geometry_types': sorted(types)},
+        },
+    }
+
+
+def geolayer_table(featureCollection):
+    """Return the features of `featureCollection` as a pyarrow Table with
+    their id, centroid, properties (one column each) and WKB geometry.
+
+    """
+    import pyarrow as pa
+
+    features = featureCollection['features']
+    properties = {}
+    for feature in features:
+        for key in (feature.get('properties') or {}):
+            properties.setdefault(key, None)
+    columns = {
+        'id': pa.array([feature.get('id') for feature in features], pa.string()),
+        'centroid': pa.array([feature.get('centroid') for feature in features], pa.list_(pa.float64(), 2)),
+    }
+    for key in properties:
+        if key not in columns and key != 'geometry':
+            columns[key] = pa.array([(feature.get('properties') or {}).get(key) for feature in features])
+    columns['geometry'] = pa.array([to_wkb(feature['geometry']) if feature.get('geometry') else None for feature in features], pa.binary())
+    return pa.table(columns)
+
+
+def write_geo_table(table, output_file, output_format):
+    """Write a table from `geolayer_table` as GeoParquet or Feather, with
+    the 'geo' metadata that geopandas reads.
+
+    """
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+
+    metadata = {**(table.schema.metadata or {}), b'geo': json.dumps(_geo_metadata(table)).encode('utf-8')}
+    table = table.replace_schema_metadata(metadata)
+    if output_format == 'geoparquet':
+        pq.write_table(table, output_file, compression='zstd')
+    elif output_format == 'feather':
+        feather.write_feather(table, output_file, compression='zstd')
+    else:
+        raise Exception(f"Unrecognized output_format '{output_format}'")
+
+
+def save_geolayer(featureCollection, output_file, output_format='geojson', precision=DEFAULT_PRECISION):
+    """Save a layer as indented GeoJSON, compact GeoJSON (on a
+    single line, with coordinates rounded to `precision` decimals),
+    GeoParquet or Feather.
+
+    """
+    if output_format == 'geojson':
+        with open(output_file, 'w') as f:
+            json.dump(featureCollection, f, indent=2)
+    elif output_format == 'geojson-compact':
+        with open(output_file, 'w') as f:
+            json.dump(compact_geolayer(featureCollection, precision), f, separators=(',', ':'))
+    elif output_format in ('geoparquet', 'feather'):
+        try:
+            import pyarrow
+        except ImportError as e:
+            raise ImportError(f"{e}. To save layers as {output_format} you need to install pyarrow, for example: pip install pyarrow")
+        write_geo_table(geolayer_table(featureCollection), output_file, output_format)
+    else:
+        raise Exception(f"Unrecognized output_format '{output_format}'. Choose one from: {', '.join(GEOLAYER_FORMATS)}")
+
+
+# zoom levels of web maps simplified at once, and cached, when a layer is
+# first simplified
+ZOOM_LEVELS = [4, 6, 8, 10, 12]
+
+
+def zoom_tolerance(zoom):
+    """Simplification tolerance (in degrees) of about a pixel at `zoom`."""
+    return 360 / (256 * 2**zoom)
+
+
+def simplified_suffix(tolerance=None):
+    return f'.tolerance-{tolerance!r}.json' if tolerance else '.json'
+
+
+def polygons(geometry):
+    # the coordinates of each polygon of a geometry
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    if geometry['type'] == 'GeometryCollection':
+        return [polygon for part in geometry['geometries'] for polygon in polygons(part)]
+    return []
+
+
+def _douglas_peucker(points, tolerance):
+    # keeps the ends, and the points further than `tolerance` from the
+    # simplified line
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, direction = points[first], points[last] - points[first]
+        inner = points[first + 1:last] - start
+        length = np.hypot(*direction)
+        if length:
+            distances = np.abs(direction[0] * inner[:, 1] - direction[1] * inner[:, 0]) / length
+        else: # closed arcs
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        i = int(distances.argmax())
+        if distances[i] > tolerance:
+            keep[first + 1 + i] = True
+            stack.append((first, first + 1 + i))
+            stack.append((first + 1 + i, last))
+    return points[keep]
+
+
+def _topology(featureCollection):
+    # splits the rings into arcs between the vertices where three or more
+    # borders meet, so a border shared by two zones is a single arc
+    rings = []
+    for i, feature in enumerate(featureCollection['features']):
+        for j, polygon in enumerate(polygons(feature.get('geometry'))):
+            for k, ring in enumerate(polygon):
+                ring = np.asarray(ring, dtype=np.float64)[:, :2]
+                if len(ring) and (ring[0] == ring[-1]).all():
+                    ring = ring[:-1]
+                if len(ring):
+                    ring = ring[np.r_[True, (ring[1:] != ring[:-1]).any(axis=1)]]
+                rings.append((i, j, k, ring))
+    if not rings:
+        return np.empty((0, 2)), [], []
+
+    vertices, ids = np.unique(np.vstack([ring for _, _, _, ring in rings]), axis=0, return_inverse=True)
+    ids = ids.ravel()
+    bounds = np.cumsum([0] + [len(ring) for _, _, _, ring in rings])
+    ring_ids = [ids[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    edges = np.vstack([np.column_stack([ring, np.roll(ring, -1)]) for ring in ring_ids if len(ring) > 1])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    junctions = np.bincount(edges.ravel(), minlength=len(vertices)) != 2
+    for ring in ring_ids:
+        if len(ring) and not junctions[ring].any():
+            junctions[ring.min()] = True # rings without junctions start at their lowest vertex
+
+    arcs, arc_index, ring_arcs = [], {}, []
+    for ring in ring_ids:
+        positions = np.flatnonzero(junctions[ring])
+        if not len(positions):
+            ring_arcs.append([])
+            continue
+        ring = np.roll(ring, -positions[0])
+        positions = np.append(positions - positions[0], len(ring))
+        ring = np.append(ring, ring[0])
+        parts = []
+        for start, end in zip(positions[:-1], positions[1:]):
+            arc = tuple(ring[start:end + 1])
+            reverse = arc[::-1] < arc
+            key = arc[::-1] if reverse else arc
+            if key not in arc_index:
+                arc_index[key] = len(arcs)
+                arcs.append(vertices[list(key)])
+            parts.append((arc_index[key], reverse))
+        ring_arcs.append(parts)
+    return arcs, [ring[:3] for ring in rings], ring_arcs
+
+
+def _join_arcs(arcs, parts):
+    ring = np.vstack([arcs[arc][::-1] if reverse else arcs[arc] for arc, reverse in parts])
+    return ring[np.r_[True, (ring[1:] != ring[:-1]).any(axis=1)]]
+
+
+def simplify_levels(featureCollection, tolerances):
+    """Return {tolerance: simplified copy of `featureCollection`} for each
+    of the `tolerances` (in the units of the coordinates).
+
+    Borders are simplified with Douglas-Peucker once for both zones they
+    separate, so simplified zones neither overlap nor leave gaps. Rings
+    left with less than three points are dropped, except the outer ring of
+    the largest polygon of each zone, which keeps all its points.
+
+    """
+    arcs, ring_keys, ring_arcs = _topology(featureCollection)
+    zone_rings = {}
+    for (i, j, k), parts in zip(ring_keys, ring_arcs):
+        if parts:
+            zone_rings.setdefault(i, {}).setdefault(j, {})[k] = parts
+
+    levels = {}
+    for tolerance in tolerances:
+        simplified_arcs = [_douglas_peucker(arc, tolerance) for arc in arcs]
+        features = []
+        for i, feature in enumerate(featureCollection['features']):
+            if i not in zone_rings:
+                features.append(feature)
+                continue
+            outer_rings = {j: rings[0] for j, rings in zone_rings[i].items() if 0 in rings}
+            largest = max(outer_rings, key=lambda j: sum(len(arcs[arc]) for arc, _ in outer_rings[j]), default=None)
+            coordinates = []
+            for j, rings in sorted(zone_rings[i].items()):
+                if j not in outer_rings:
+                    continue
+                polygon = []
+                for k, parts in sorted(rings.items()):
+                    ring = _join_arcs(simplified_arcs, parts)
+                    if len(ring) < 4: # a closed ring needs 3 different points
+                        if k:
+                            continue # a hole, dropped
+                        if j != largest:
+                            break # an outer ring, the whole polygon is dropped
+                        ring = _join_arcs(arcs, parts)
+                    polygon.append(ring.tolist())
+                if polygon:
+                    coordinates.append(polygon)
+            if feature['geometry']['type'] == 'Polygon':
+                geometry = {'type': 'Polygon', 'coordinates': coordinates[0]}
+            else:
+                geometry = {'type': 'MultiPolygon', 'coordinates': coordinates}
+            features.append({**feature, 'geometry': geometry})
+        levels[tolerance] = {**featureCollection, 'features': features}
+    return levels
+
+
+def simplify_geolayer(featureCollection, tolerance):
+    """Return a copy of `featureCollection` simplified with `tolerance`, see
+    `simplify_levels`.
+
+    """
+    return simplify_levels(featureCollection, [tolerance])[tolerance]
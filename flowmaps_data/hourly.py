@@ -0,0 +1,322 @@
+import os
+import re
+import json
+import hashlib
+import requests
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from .schemas import get_schema, apply_schema
+from .parts import part_path, find_parts
+
+
+# columns of the maestra1 files, with the same types used when they were
+# read with pandas (str, int and float)
+MAESTRA1_COLUMNS = {
+    'fecha': 'string',
+    'origen': 'string',
+    'destino': 'string',
+    'actividad_origen': 'string',
+    'actividad_destino': 'string',
+    'residencia': 'int64',
+    'edad': 'string',
+    'periodo': 'int64',
+    'distancia': 'string',
+    'viajes': 'float64',
+    'viajes_km': 'float64',
+}
+
+# bytes of decompressed CSV parsed at a time, each block becomes a row group
+BLOCK_SIZE = 64 * 1024**2
+
+# bytes read from the network or from disk at a time
+CHUNK_SIZE = 1024**2
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def _remove(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def download_file(url, path, timeout=None):
+    """Download `url` to `path`. If `path` already holds the beginning of
+    the file (from an interrupted download), only the rest is requested,
+    with a Range request. Returns the size of the file and its validator
+    (ETag or Last-Modified).
+
+    The url and validator of the partial file are kept in `path`.json. A
+    partial file of another url is downloaded again, and the rest is only
+    appended if the file did not change since (If-Range).
+
+    """
+    meta_path = path + '.json'
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        meta = {}
+    if meta.get('url') != url:
+        _remove(path)
+        meta = {'url': url}
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    headers = {}
+    if size:
+        headers['Range'] = f'bytes={size}-'
+        if meta.get('validator'):
+            headers['If-Range'] = meta['validator']
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416: # nothing left to download
+            return size, meta.get('validator')
+        response.raise_for_status()
+        # a server that ignores the Range header, or a file that changed,
+        # sends the whole file again
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        if mode == 'wb':
+            meta['validator'] = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        with open(path, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+    return os.path.getsize(path), meta.get('validator')
+
+
+def file_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+FILTER_OPERATORS = ['==', '!=', '<', '<=', '>', '>=', 'in', 'startswith']
+
+
+def _filter_expression(filters):
+    # filters are (column, operator, value) tuples, all of them must match
+    import pyarrow.compute as pc
+
+    expression = None
+    for column, op, value in filters:
+        field = pc.field(column)
+        if op == 'in':
+            condition = field.isin(value)
+        elif op == 'startswith':
+            prefixes = [value] if isinstance(value, str) else value
+            condition = None
+            for prefix in prefixes:
+                match = pc.starts_with(field, pattern=prefix)
+                condition = match if condition is None else condition | match
+        elif op == '==': condition = field == value
+        elif op == '!=': condition = field != value
+        elif op == '<': condition = field < value
+        elif op == '<=': condition = field <= value
+        elif op == '>': condition = field > value
+        elif op == '>=': condition = field >= value
+        else:
+            raise Exception(f"Unrecognized filter operator '{op}'. Choose one from: {', '.join(FILTER_OPERATORS)}")
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def convert_hourly_mobility(source_path, path, columns=None, filters=None, sort_by=None, dictionary=True, compression='zstd'):
+    """Convert the gzipped maestra1 file `source_path` into the Parquet file
+    `path`, one block at a time.
+
+    Only `columns` are kept (all of them by default), and only the rows
+    matching all `filters`, given as (column, operator, value) tuples, e.g.
+    ('origen', 'startswith', '28'), ('periodo', '>=', 7) or
+    ('distancia', 'in', ['002-005', '005-010']). Each row group is sorted by
+    the `sort_by` columns, and string columns are dictionary encoded, so
+    readers can skip row groups using the Parquet statistics.
+
+    The file is written to a temporary path and only moved into place once
+    complete, so a failed conversion never leaves a partial file behind.
+    Returns the number of rows written.
+
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as csv
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(f"{e}. To download hourly mobility you need to install pyarrow, for example: pip install pyarrow")
+
+    columns = list(columns or MAESTRA1_COLUMNS)
+    filters = filters or []
+    sort_by = sort_by or []
+    # the filtered and sorting columns are read too, even if they are not kept
+    read_columns = list(dict.fromkeys(columns + [column for column, _, _ in filters] + sort_by))
+    unknown = [column for column in read_columns if column not in MAESTRA1_COLUMNS]
+    if unknown:
+        raise Exception(f"Unrecognized columns: {', '.join(unknown)}. Choose from: {', '.join(MAESTRA1_COLUMNS)}")
+    expression = _filter_expression(filters) if filters else None
+
+    column_types = {column: pa.type_for_alias(type) for column, type in MAESTRA1_COLUMNS.items()}
+    read_options = csv.ReadOptions(block_size=BLOCK_SIZE)
+    parse_options = csv.ParseOptions(delimiter='|')
+    convert_options = csv.ConvertOptions(column_types=column_types, strings_can_be_null=True, include_columns=read_columns)
+    schema = pa.schema([
+        pa.field(column, pa.dictionary(pa.int32(), pa.string()) if dictionary and MAESTRA1_COLUMNS[column] == 'string' else column_types[column])
+        for column in columns
+    ])
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    num_rows = 0
+    stream = pa.input_stream(source_path, compression='gzip')
+    reader = csv.open_csv(stream, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+    try:
+        with pq.ParquetWriter(tmp_path, schema, compression=compression) as writer:
+            for batch in reader:
+                table = pa.Table.from_batches([batch])
+                if expression is not None:
+                    table = table.filter(expression)
+                if not table.num_rows:
+                    continue
+                if sort_by:
+                    table = table.sort_by([(column, 'ascending') for column in sort_by])
+                writer.write_table(table.select(columns).cast(schema))
+                num_rows += table.num_rows
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return num_rows
+
+
+def ingest_hourly_mobility(url, path, timeout=None, **options):
+    """Download the gzipped maestra1 file at `url` and convert it into the
+    Parquet file `path` (see `convert_hourly_mobility` for the `options`).
+
+    The compressed file is kept next to `path` until it has been converted,
+    so an interrupted run resumes where it stopped. Returns a dict with the
+    size, checksum and validator of the downloaded file and the number of
+    rows.
+
+    """
+    source_path = path + '.gz.part'
+    size, validator = download_file(url, source_path, timeout=timeout)
+    checksum = file_checksum(source_path)
+    try:
+        num_rows = convert_hourly_mobility(source_path, path, **options)
+    finally:
+        # a file that can not be converted is downloaded again next time
+        _remove(source_path, source_path + '.json')
+    return {'size': size, 'checksum': checksum, 'validator': validator, 'num_rows': num_rows}
+
+
+def _manifest_path(output_dir, shard=None):
+    return part_path(os.path.join(output_dir, MANIFEST_FILE), shard)
+
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def load_manifest(output_dir, shard=None):
+    """Return the manifest of the hourly mobility files in `output_dir`: a
+    dict with the url, size, checksum and state of each date. Each shard
+    keeps its own manifest, on top of the merged one.
+
+    """
+    manifest = _read_manifest(_manifest_path(output_dir))
+    if shard:
+        manifest.update(_read_manifest(_manifest_path(output_dir, shard)))
+    return manifest
+
+
+def save_manifest(output_dir, manifest, shard=None):
+    path = _manifest_path(output_dir, shard)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def merge_manifests(output_dir):
+    """Merge the manifests written by the shards of a download into the
+    manifest of `output_dir`.
+
+    """
+    manifest = load_manifest(output_dir)
+    parts = find_parts(_manifest_path(output_dir))
+    for part in parts:
+        manifest.update(_read_manifest(part))
+    save_manifest(output_dir, manifest)
+    for part in parts:
+        os.remove(part)
+    print(f'{len(parts)} manifests merged into:', _manifest_path(output_dir))
+
+
+def hourly_mobility_files(input_dir, start_date=None, end_date=None):
+    """Return the {date: path} of the hourly mobility files in `input_dir`
+    (as written by `download_hourly_mobility`) between the given dates.
+
+    """
+    files = {}
+    for filename in sorted(os.listdir(input_dir)):
+        match = re.match(r'^mitma_mov-maestra1-(\d{4}-\d{2}-\d{2})\.parquet$', filename)
+        if not match:
+            continue
+        date = match.group(1)
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        files[date] = os.path.join(input_dir, filename)
+    return files
+
+
+def _aggregate_hourly_file(path, periodos=None, distancias=None, mapping=None):
+    import pyarrow.parquet as pq
+
+    filters = []
+    if periodos is not None:
+        filters.append(('periodo', 'in', list(periodos)))
+    if distancias is not None:
+        filters.append(('distancia', 'in', list(distancias)))
+    columns = ['fecha', 'origen', 'destino', 'viajes']
+    missing = [column for column in columns + [f[0] for f in filters] if column not in pq.read_schema(path).names]
+    if missing:
+        raise Exception(f"Missing columns {', '.join(missing)} in file: {path}")
+    # only the needed columns and row groups are read
+    df = pq.read_table(path, columns=columns, filters=filters or None).to_pandas()
+
+    df = df.rename(columns={'fecha': 'date', 'origen': 'source', 'destino': 'target', 'viajes': 'trips'})
+    if mapping is not None:
+        # aggregate to another layer, zones missing from the mapping are dropped
+        df['source'] = df['source'].astype(str).map(mapping)
+        df['target'] = df['target'].astype(str).map(mapping)
+    df['date'] = pd.to_datetime(df['date'].astype(str), format='%Y%m%d')
+    df = df.groupby(['source', 'target', 'date'], observed=True, sort=False)['trips'].sum().reset_index()
+    return apply_schema(df, get_schema('mitma_mov.daily_mobility_matrix'))
+
+
+def aggregate_hourly_mobility(input_dir, start_date=None, end_date=None, periodos=None, distancias=None, mapping=None, max_workers=1):
+    """Build daily origin-destination matrices from the hourly mobility
+    files in `input_dir`, with the same columns as `daily_mobility`.
+
+    The trips (viajes) are summed by origin, destination and date, counting
+    only the given `periodos` (hours) and `distancias` (distance bands) when
+    given. `mapping` is a dict from MITMA district ids to the zones of
+    another layer, to aggregate the matrices at that layer. Each file is
+    aggregated on its own, by a pool of `max_workers` processes, so only
+    the daily matrices are kept in memory.
+
+    """
+    files = hourly_mobility_files(input_dir, start_date, end_date)
+    if not files:
+        raise Exception(f"No hourly mobility files found in: {input_dir}")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_aggregate_hourly_file, path, periodos, distancias, mapping) for path in files.values()]
+        frames = [future.result() for future in futures]
+    # categories differ between days, make them common again
+    df = pd.concat(frames, ignore_index=True)
+    return apply_schema(df, get_schema('mitma_mov.daily_mobility_matrix'))
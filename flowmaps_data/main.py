@@ -4,9 +4,22 @@ import sys
 import argparse
 
 from . import commands
+from .utils import FlowmapsClient, DEFAULT_PAGE_SIZE
+from .cache import ResponseCache, DEFAULT_CACHE_DIR
+from .geo import GEOLAYER_FORMATS, DEFAULT_PRECISION
+from .decoders import JSON_DECODERS
 
 
 CONFIG = {
+    "merge": {
+        "fn": commands.merge,
+        "argparse": {
+            "--output-file": {"required": False, "dest": "output_file", "default": None, "type": str, "help": "output file of the sharded download", },
+            "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "output format of the sharded download, or the one of layers (geojson, geojson-compact, geoparquet or feather)", },
+            "--output-dir": {"required": False, "dest": "output_dir", "default": None, "type": str, "help": "output directory of a sharded hourly_mobility download", },
+            "--keep-parts": {"required": False, "dest": "keep_parts", "default": False, "action": "store_true", "help": "do not remove the parts after merging them", },
+        },
+    },
     "layers": {
         "subcommands": {
             "list": {
@@ -19,15 +32,22 @@ CONFIG = {
                     "--layer": {"required": True, "type": str, "help": "", },
                     "--provenance": {"required": False, "default": False, "action": "store_true", "help": "show provenance", },
                     "--plot": {"required": False, "default": False, "action": "store_true", "help": "", },
+                    "--simplify": {"required": False, "dest": "simplify", "default": None, "type": float, "help": "simplify the borders of the zones with this tolerance, in degrees (e.g. 0.001), keeping the borders shared by zones", },
                 },
             },
             "download": {
                 "fn": commands.download_layer,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--layer": {"required": True, "type": str, "help": "", },
                     "--output-file": {"required": False,"dest": "output_file",  "default": None, "type": str, "help": "", },
                     "--plot": {"required": False, "default": False, "action": "store_true", "help": "", },
+                    "--simplify": {"required": False, "dest": "simplify", "default": None, "type": float, "help": "simplify the borders of the zones with this tolerance, in degrees (e.g. 0.001), keeping the borders shared by zones", },
                     "--no_save": {"required": False, "default": False, "action": "store_true", "help": "", },
+                    "--output-format": {"required": False, "dest": "output_format", "default": "geojson", "choices": GEOLAYER_FORMATS, "type": str, "help": "geojson-compact rounds the coordinates to --precision decimals and leaves out the indentation. geoparquet and feather store the geometry as WKB", },
+                    "--precision": {"required": False, "dest": "precision", "default": DEFAULT_PRECISION, "type": int, "help": "decimals of the coordinates in geojson-compact", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
                 },
             },
         },
@@ -50,11 +70,16 @@ CONFIG = {
             "download": {
                 "fn": commands.download_covid19,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--ev": {"required": True, "type": str, "help": "", },
                     "--output-file": {"required": True, "dest": "output_file", "type": str, "help": "", },
                     "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
                     "--start-date": {"dest": "start_date", "required": False, "type": str, "help": "", },
                     "--end-date": {"dest": "end_date", "required": False, "type": str, "help": "", },
+                    "--columns": {"required": False, "type": str, "help": "comma separated list of columns to download, e.g. id,date,new_cases", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages (or shards, with --shard-by) to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
+                    "--shard-by": {"required": False, "dest": "shard_by", "default": None, "choices": ["day", "week"], "help": "split the date range into one query per day or week, downloaded concurrently. Needs --start-date and --end-date", },
                 },
             },
         },
@@ -75,11 +100,16 @@ CONFIG = {
             "download": {
                 "fn": commands.download_data,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--ev": {"required": True, "type": str, "help": "", },
                     "--output-file": {"required": True, "dest": "output_file", "type": str, "help": "", },
                     "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
                     "--start-date": {"dest": "start_date", "required": False, "type": str, "help": "", },
                     "--end-date": {"dest": "end_date", "required": False, "type": str, "help": "", },
+                    "--columns": {"required": False, "type": str, "help": "comma separated list of columns to download, e.g. id,evstart and the fields of the dataset shown by describe", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages (or shards, with --shard-by) to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
+                    "--shard-by": {"required": False, "dest": "shard_by", "default": None, "choices": ["day", "week"], "help": "split the date range into one query per day or week, downloaded concurrently. Needs --start-date and --end-date", },
                 },
             },
         },
@@ -106,9 +136,29 @@ CONFIG = {
             "download": {
                 "fn": commands.download_hourly_mobility,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--start-date": {"required": True, "dest": "start_date", "type": str, "help": "", },
                     "--end-date": {"required": True, "dest": "end_date", "type": str, "help": "", },
                     "--output-dir": {"required": True, "dest": "output_dir", "type": str, "help": "", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of days to download concurrently", },
+                    "--columns": {"required": False, "dest": "columns", "default": None, "type": str, "help": "comma separated list of columns to keep", },
+                    "--filter": {"required": False, "dest": "filters", "default": None, "action": "append", "type": str, "help": "keep only the rows matching <column><operator><value>, e.g. periodo>=7, origen^=28 (starts with) or distancia=002-005,005-010. Can be repeated", },
+                    "--sort-by": {"required": False, "dest": "sort_by", "default": None, "type": str, "help": "comma separated list of columns to sort each row group by, e.g. origen,destino", },
+                    "--compression": {"required": False, "dest": "compression", "default": "zstd", "choices": ["zstd", "snappy", "gzip", "brotli", "lz4", "none"], "help": "parquet compression codec", },
+                },
+            },
+            "aggregate": {
+                "fn": commands.aggregate_hourly_mobility_files,
+                "argparse": {
+                    "--input-dir": {"required": True, "dest": "input_dir", "type": str, "help": "directory with the files written by download", },
+                    "--output-file": {"required": True, "dest": "output_file", "type": str, "help": "", },
+                    "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
+                    "--start-date": {"required": False, "dest": "start_date", "default": None, "type": str, "help": "", },
+                    "--end-date": {"required": False, "dest": "end_date", "default": None, "type": str, "help": "", },
+                    "--periodos": {"required": False, "dest": "periodos", "default": None, "type": str, "help": "count only the trips starting at these hours, e.g. 7-9,18", },
+                    "--distancias": {"required": False, "dest": "distancias", "default": None, "type": str, "help": "count only the trips in these distance bands, e.g. 002-005,005-010", },
+                    "--mapping-file": {"required": False, "dest": "mapping_file", "default": None, "type": str, "help": "csv file mapping each MITMA district id (first column) to a zone of another layer (second column)", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of files to aggregate concurrently", },
                 },
             },
         },
@@ -132,6 +182,7 @@ CONFIG = {
             "download": {
                 "fn": commands.download_daily_mobility,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--source-layer": {"required": True, "dest": "source_layer", "type": str, "help": "", },
                     "--target-layer": {"required": True, "dest": "target_layer", "type": str, "help": "", },
                     "--source": {"required": False, "type": str, "help": "", },
@@ -140,6 +191,21 @@ CONFIG = {
                     "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
                     "--start-date": {"dest": "start_date", "required": False, "type": str, "help": "", },
                     "--end-date": {"dest": "end_date", "required": False, "type": str, "help": "", },
+                    "--columns": {"required": False, "type": str, "help": "comma separated list of columns to download, e.g. source,target,date,trips", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages (or shards, with --shard-by) to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
+                    "--shard-by": {"required": False, "dest": "shard_by", "default": None, "choices": ["day", "week"], "help": "split the date range into one query per day or week, downloaded concurrently. Needs --start-date and --end-date", },
+                },
+            },
+            "sync": {
+                "fn": commands.sync_daily_mobility,
+                "argparse": {
+                    "--source-layer": {"required": True, "dest": "source_layer", "type": str, "help": "", },
+                    "--target-layer": {"required": True, "dest": "target_layer", "type": str, "help": "", },
+                    "--store-dir": {"required": True, "dest": "store_dir", "type": str, "help": "directory of the local store, a parquet dataset partitioned by layers and date", },
+                    "--start-date": {"dest": "start_date", "required": False, "type": str, "help": "", },
+                    "--end-date": {"dest": "end_date", "required": False, "type": str, "help": "", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 4, "type": int, "help": "number of dates to download concurrently", },
                 },
             },
         },
@@ -159,11 +225,16 @@ CONFIG = {
             "download": {
                 "fn": commands.download_zone_movements,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--layer": {"required": True, "type": str, "help": "", },
                     "--output-file": {"required": True, "dest": "output_file", "type": str, "help": "", },
                     "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
                     "--start-date": {"dest": "start_date", "required": False, "type": str, "help": "", },
                     "--end-date": {"dest": "end_date", "required": False, "type": str, "help": "", },
+                    "--columns": {"required": False, "type": str, "help": "comma separated list of columns to download, e.g. id,date,viajes", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages (or shards, with --shard-by) to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
+                    "--shard-by": {"required": False, "dest": "shard_by", "default": None, "choices": ["day", "week"], "help": "split the date range into one query per day or week, downloaded concurrently. Needs --start-date and --end-date", },
                 },
             },
         },
@@ -184,11 +255,16 @@ CONFIG = {
             "download": {
                 "fn": commands.download_population,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--layer": {"required": True, "type": str, "help": "", },
                     "--output-file": {"required": True, "dest": "output_file", "type": str, "help": "", },
                     "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
                     "--start-date": {"dest": "start_date", "required": False, "type": str, "help": "", },
                     "--end-date": {"dest": "end_date", "required": False, "type": str, "help": "", },
+                    "--columns": {"required": False, "type": str, "help": "comma separated list of columns to download, e.g. id,date,population", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages (or shards, with --shard-by) to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
+                    "--shard-by": {"required": False, "dest": "shard_by", "default": None, "choices": ["day", "week"], "help": "split the date range into one query per day or week, downloaded concurrently. Needs --start-date and --end-date", },
                 },
             },
         },
@@ -208,12 +284,17 @@ CONFIG = {
             "download": {
                 "fn": commands.download_risk,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--source-layer": {"dest": "source_layer", "required": True, "type": str, "help": "", },
-                    "--target-layer": {"dest": "target_layer", "required": True, "type": str, "help": "", },
+                    "--target-layer": {"dest": "target_layer", "required": True, "type": str, "help": "one or more layers, separated by commas", },
                     "--ev": {"dest": "ev", "required": True, "type": str, "help": "", },
-                    "--date": {"dest": "date", "required": True, "type": str, "help": "", },
+                    "--date": {"dest": "date", "required": False, "default": None, "type": str, "help": "", },
+                    "--start-date": {"required": False, "dest": "start_date", "default": None, "type": str, "help": "instead of --date, compute the risk for all the dates from --start-date to --end-date", },
+                    "--end-date": {"required": False, "dest": "end_date", "default": None, "type": str, "help": "", },
                     "--output-file": {"required": True, "dest": "output_file", "type": str, "help": "", },
                     "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
                 },
             },
         },
@@ -234,11 +315,16 @@ CONFIG = {
             "download": {
                 "fn": commands.download_deceased,
                 "argparse": {
+                    "--shard": {"required": False, "dest": "shard", "default": None, "type": str, "help": "download only the i-th of N parts of the data, e.g. 0/4, to split a download between machines. Combine the parts with the merge command", },
                     "--ev": {"required": True, "type": str, "help": "", },
                     "--output-file": {"required": True, "dest": "output_file", "type": str, "help": "", },
                     "--output-format": {"required": False, "dest": "output_format", "default": "csv", "type": str, "help": "", },
                     "--start-date": {"dest": "start_date", "required": False, "type": str, "help": "", },
                     "--end-date": {"dest": "end_date", "required": False, "type": str, "help": "", },
+                    "--columns": {"required": False, "type": str, "help": "comma separated list of columns to download, e.g. id,evstart and the fields of the dataset shown by describe", },
+                    "--max-workers": {"required": False, "dest": "max_workers", "default": 1, "type": int, "help": "number of pages (or shards, with --shard-by) to download concurrently", },
+                    "--pagination": {"required": False, "default": "page", "choices": ["page", "keyset"], "type": str, "help": "keyset walks the collection by _id, faster for full-collection exports", },
+                    "--shard-by": {"required": False, "dest": "shard_by", "default": None, "choices": ["day", "week"], "help": "split the date range into one query per day or week, downloaded concurrently. Needs --start-date and --end-date", },
                 },
             },
         }
@@ -246,6 +332,16 @@ CONFIG = {
 }
 
 
+# options accepted by every subcommand, used to set up the API client
+CLIENT_ARGPARSE = {
+    "--cache-dir": {"required": False, "dest": "cache_dir", "default": DEFAULT_CACHE_DIR, "type": str, "help": "directory where API responses are cached", },
+    "--no-cache": {"required": False, "dest": "no_cache", "default": False, "action": "store_true", "help": "do not use the response cache", },
+    "--refresh": {"required": False, "default": False, "action": "store_true", "help": "ignore cached responses, download everything again", },
+    "--page-size": {"required": False, "dest": "page_size", "default": str(DEFAULT_PAGE_SIZE), "type": str, "help": "documents per page of the API responses, or auto to tune it per collection from the latency and size of the pages", },
+    "--json-decoder": {"required": False, "dest": "json_decoder", "default": "auto", "choices": ["auto"] + JSON_DECODERS, "type": str, "help": "library used to decode the API responses, auto uses orjson or ujson when installed", },
+}
+
+
 usage_str = '''
 usage: flowmaps-data [-h] COLLECTION [list describe download]
 
@@ -255,7 +351,9 @@ examples:
     flowmaps-data layers list
     flowmaps-data layers describe --layer cnig_provincias --provenance
     flowmaps-data layers describe --layer cnig_provincias --plot
+    flowmaps-data layers describe --layer zbs_15 --plot --simplify 0.005
     flowmaps-data layers download --layer cnig_provincias
+    flowmaps-data layers download --layer zbs_15 --output-format geoparquet
 
     # Consolidated COVID-19 data
     flowmaps-data covid19 list
@@ -277,12 +375,19 @@ examples:
     flowmaps-data daily_mobility list-dates
     flowmaps-data daily_mobility describe
     flowmaps-data daily_mobility download --source-layer cnig_provincias --target-layer cnig_provincias --start-date 2020-10-10 --end-date 2020-10-16 --output-file out.csv
+    flowmaps-data daily_mobility sync --source-layer cnig_provincias --target-layer cnig_provincias --store-dir store/
 
     # Daily zone movements (from MITMA)
     flowmaps-data zone_movements list
     flowmaps-data zone_movements describe
     flowmaps-data zone_movements download --layer cnig_provincias --output-file out.csv --start-date 2020-10-10 --end-date 2020-10-10
 
+    # Hourly mobility (raw MITMA files, converted to parquet)
+    flowmaps-data hourly_mobility list-dates
+    flowmaps-data hourly_mobility download --start-date 2020-10-10 --end-date 2020-10-16 --output-dir data/ --max-workers 4
+    flowmaps-data hourly_mobility download --start-date 2020-10-10 --end-date 2020-10-16 --output-dir data/ --columns origen,destino,periodo,viajes --filter origen^=28 --filter periodo>=7 --sort-by origen,destino
+    flowmaps-data hourly_mobility aggregate --input-dir data/ --start-date 2020-10-10 --end-date 2020-10-16 --periodos 7-9 --output-file out.csv --max-workers 4
+
     # Raw datasets
     flowmaps-data datasets list
     flowmaps-data datasets describe --ev ES.covid_cpro
@@ -292,6 +397,7 @@ examples:
     flowmaps-data risk list
     flowmaps-data risk list-dates
     flowmaps-data risk download --source-layer cnig_provincias --target-layer cnig_provincias --ev ES.covid_cpro --date 2020-10-10 --output-file out.csv --output-format csv
+    flowmaps-data risk download --source-layer cnig_provincias --target-layer cnig_provincias,cnig_ccaa --ev ES.covid_cpro --start-date 2020-10-01 --end-date 2020-10-31 --output-file out.csv
 '''
 
 def print_usage():
@@ -300,10 +406,15 @@ def print_usage():
 
 def execute_command(fn, argparse_spec, commandline):
     parser = argparse.ArgumentParser(description='')
-    for arg, options in argparse_spec.items():
+    for arg, options in {**argparse_spec, **CLIENT_ARGPARSE}.items():
         parser.add_argument(arg, **options)
-    args = parser.parse_args(commandline)
-    fn(**vars(args))
+    args = vars(parser.parse_args(commandline))
+    cache_dir, no_cache, refresh, decoder = args.pop('cache_dir'), args.pop('no_cache'), args.pop('refresh'), args.pop('json_decoder')
+    page_size = args.pop('page_size')
+    page_size = int(page_size) if page_size.isdigit() else page_size
+    cache = None if no_cache else ResponseCache(cache_dir, refresh=refresh, decoder=decoder)
+    with FlowmapsClient(cache=cache, decoder=decoder, page_size=page_size) as client:
+        fn(**args, client=client)
 
 
 def parse_commandline(config, commandline):
@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import glob
+import shutil
+import pandas as pd
+
+from .utils import save_df
+from .geo import write_geo_table
+from .schemas import cast_to_schema
+
+
+def parse_shard(shard):
+    """Parse a shard given as 'i/N' (0 <= i < N) into an (i, N) tuple."""
+    if shard is None:
+        return None
+    match = re.match(r'^(\d+)/(\d+)$', shard)
+    if not match or not 0 <= int(match.group(1)) < int(match.group(2)):
+        raise Exception(f"Unrecognized shard '{shard}'. Use i/N, with 0 <= i < N, e.g. 0/4")
+    return int(match.group(1)), int(match.group(2))
+
+
+def part_path(path, shard):
+    """Path of the part of `path` written by `shard`, or `path` itself
+    when not sharded.
+
+    """
+    if shard is None:
+        return path
+    i, n = shard
+    return f'{path}.part-{i}-of-{n}'
+
+
+def find_parts(path):
+    """Return the paths of all the parts of `path`, in shard order. Raises
+    if some of them are missing.
+
+    """
+    parts = {}
+    for part in glob.glob(glob.escape(path) + '.part-*-of-*'):
+        match = re.match(r'^.*\.part-(\d+)-of-(\d+)$', part)
+        if match:
+            parts[int(match.group(1)), int(match.group(2))] = part
+    if not parts:
+        raise Exception(f"No parts found for: {path}")
+    counts = {n for _, n in parts}
+    if len(counts) > 1:
+        raise Exception(f"Parts of {path} come from different numbers of shards: {', '.join(map(str, sorted(counts)))}")
+    n = counts.pop()
+    missing = [str(i) for i in range(n) if (i, n) not in parts]
+    if missing:
+        raise Exception(f"Missing parts {', '.join(missing)} of {n} for: {path}")
+    return [parts[i, n] for i in range(n)]
+
+
+def _read_csv_parts(parts):
+    for part in parts:
+        try:
+            # as text, so the values are written back exactly as they were
+            yield from pd.read_csv(part, dtype=str, keep_default_na=False, chunksize=100000)
+        except pd.errors.EmptyDataError: # a shard without rows
+            continue
+
+
+def _merge_json(parts, output_file, array):
+    num_rows = 0
+    with open(output_file, 'w') as f:
+        if array: f.write('[\n')
+        for part in parts:
+            with open(part) as part_f:
+                for line in part_f:
+                    line = line.rstrip('\n')
+                    if array:
+                        # one record per line, between the brackets of the array
+                        if line in ('[', ']', ''):
+                            continue
+                        line = line.rstrip(',')
+                        if num_rows: f.write(',\n')
+                        f.write(line)
+                    elif line:
+                        f.write(line + '\n')
+                    num_rows += 1
+        if array: f.write('\n]\n')
+    return num_rows
+
+
+def _merge_parquet(parts, output_file):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    part_files = [pq.ParquetFile(part) for part in parts]
+    part_files = [part_file for part_file in part_files if part_file.metadata.num_rows]
+    if not part_files:
+        pq.write_table(pa.table({}), output_file)
+        return 0
+    # columns missing, or all missing, in some of the parts get the type
+    # they have in the others
+    table_schema = pa.unify_schemas([part_file.schema_arrow for part_file in part_files], promote_options='permissive')
+    num_rows = 0
+    with pq.ParquetWriter(output_file, table_schema) as writer:
+        for part_file in part_files:
+            for i in range(part_file.num_row_groups):
+                table = part_file.read_row_group(i)
+                writer.write_table(cast_to_schema(table, table_schema))
+                num_rows += table.num_rows
+    return num_rows
+
+
+def _merge_parquet_dataset(parts, output_dir):
+    # move the files of every part into the dataset. As when downloading,
+    # the partitions present in the parts replace the existing ones.
+    cleared = set()
+    num_files = 0
+    for part in parts:
+        for directory, _, filenames in os.walk(part):
+            relative = os.path.relpath(directory, part)
+            destination = os.path.join(output_dir, relative)
+            if filenames and relative not in cleared:
+                if os.path.isdir(destination):
+                    for filename in os.listdir(destination):
+                        if os.path.isfile(os.path.join(destination, filename)):
+                            os.remove(os.path.join(destination, filename))
+                cleared.add(relative)
+            os.makedirs(destination, exist_ok=True)
+            for filename in filenames:
+                os.replace(os.path.join(directory, filename), os.path.join(destination, filename))
+                num_files += 1
+    return num_files
+
+
+def _merge_geojson(parts, output_file, compact=False):
+    featureCollection = {'type': 'FeatureCollection', 'features': []}
+    for part in parts:
+        with open(part) as f:
+            featureCollection['features'].extend(json.load(f)['features'])
+    with open(output_file, 'w') as f:
+        if compact:
+            json.dump(featureCollection, f, separators=(',', ':'))
+        else:
+            json.dump(featureCollection, f, indent=2)
+    return len(featureCollection['features'])
+
+
+def _merge_geo_table(parts, output_file, output_format):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+
+    read = pq.read_table if output_format == 'geoparquet' else feather.read_table
+    tables = [read(part) for part in parts]
+    # the geo metadata is written again, for the features of all the parts
+    table = pa.concat_tables(tables, promote_options='default').replace_schema_metadata(None)
+    write_geo_table(table, output_file, output_format)
+    return table.num_rows
+
+
+def merge_parts(output_file, output_format='csv', keep_parts=False):
+    """Combine the parts written by the shards of a download (see
+    `part_path`) into `output_file`, in shard order.
+
+    """
+    parts = find_parts(output_file)
+    if output_format == 'csv':
+        save_df(_read_csv_parts(parts), output_file, 'csv')
+    elif output_format in ('json', 'ndjson'):
+        num_rows = _merge_json(parts, output_file, array=(output_format == 'json'))
+        print(f'{num_rows} rows written to file:', output_file)
+    elif output_format == 'parquet':
+        num_rows = _merge_parquet(parts, output_file)
+        print(f'{num_rows} rows written to file:', output_file)
+    elif output_format == 'parquet-dataset':
+        num_files = _merge_parquet_dataset(parts, output_file)
+        print(f'{num_files} files moved to dataset:', output_file)
+    elif output_format in ('geojson', 'geojson-compact'):
+        num_features = _merge_geojson(parts, output_file, compact=(output_format == 'geojson-compact'))
+        print(f'{num_features} features written to file:', output_file)
+    elif output_format in ('geoparquet', 'feather'):
+        num_features = _merge_geo_table(parts, output_file, output_format)
+        print(f'{num_features} features written to file:', output_file)
+    else:
+        raise Exception(f"Unrecognized output_format '{output_format}'")
+    if not keep_parts:
+        for part in parts:
+            if os.path.isdir(part):
+                shutil.rmtree(part)
+            else:
+                os.remove(part)
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+
+# Column types of the documents returned by each collection (and, for
+# layers.data.consolidated, by each document type). The kinds are:
+#   zone:  zone id, stored as a categorical
+#   date:  day, stored as datetime64
+#   int:   count, stored as a nullable int32
+#   float: measure, stored as float32
+# Fields not listed here are left as pandas infers them.
+SCHEMAS = {
+    'mitma_mov.daily_mobility_matrix': {
+        'source': 'zone',
+        'target': 'zone',
+        'source_layer': 'zone',
+        'target_layer': 'zone',
+        'date': 'date',
+        'trips': 'float',
+    },
+    'mitma_mov.zone_movements': {
+        'id': 'zone',
+        'date': 'date',
+        'viajes': 'int',
+        'personas': 'int',
+    },
+    'layers.data.consolidated': {
+        'covid19': {
+            'id': 'zone',
+            'layer': 'zone',
+            'ev': 'zone',
+            'date': 'date',
+            'population': 'float',
+            'new_cases': 'int',
+            'total_cases': 'int',
+            'active_cases_7': 'int',
+            'active_cases_14': 'int',
+            'new_cases_mean_7': 'float',
+            'new_cases_mean_14': 'float',
+            'active_cases_14_by_100k': 'float',
+            'active_cases_7_by_100k': 'float',
+            'new_cases_by_100k': 'float',
+            'total_cases_by_100k': 'float',
+        },
+        'population': {
+            'id': 'zone',
+            'date': 'date',
+            'population': 'float',
+        },
+        'zone_movements': {
+            'id': 'zone',
+            'date': 'date',
+            'viajes': 'int',
+            'personas': 'int',
+        },
+    },
+}
+
+# columns of the results of `risk`, merged from the collections above
+RISK_SCHEMA = {
+    'source_layer': 'zone',
+    'target_layer': 'zone',
+    'date': 'date',
+    'source': 'zone',
+    'target': 'zone',
+    'trips': 'float',
+    'source_population': 'float',
+    'source_cases_last_14_days': 'int',
+    'source_cases_last_7_days': 'int',
+    'source_cases': 'int',
+    'ev': 'zone',
+}
+
+
+def get_schema(collection, type=None):
+    schema = SCHEMAS.get(collection, {})
+    if type is not None:
+        schema = schema.get(type, {})
+    return schema
+
+
+def _convert(values, kind):
+    if kind == 'zone':
+        return pd.Categorical(values)
+    if kind == 'date':
+        return pd.to_datetime(values)
+    if kind == 'float':
+        return np.array(values, dtype='float32')
+    if kind == 'int':
+        values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        counts = values[~np.isnan(values)]
+        if not (np.all(np.isfinite(counts)) and np.all(counts % 1 == 0)):
+            return values.astype('float32') # not whole numbers after all (e.g. inf), do not truncate them
+        return pd.array(values, dtype='Int32')
+    raise ValueError(f"Unknown column kind '{kind}'")
+
+
+def frame_from_docs(docs, schema, columns=None):
+    """Build a DataFrame from a list of documents one column at a time,
+    converting the columns found in `schema` to their compact dtypes.
+
+    """
+    if columns is None:
+        columns = list(dict.fromkeys(field for doc in docs for field in doc))
+    data = {}
+    for column in columns:
+        values = [doc.get(column) for doc in docs]
+        data[column] = _convert(values, schema[column]) if column in schema else values
+    return pd.DataFrame(data, columns=columns)
+
+
+def concat_frames(frames):
+    """Concatenate DataFrames built page by page with `frame_from_docs`,
+    keeping their compact dtypes: the categories of each categorical column
+    are merged, instead of falling back to object.
+
+    """
+    frames = [df for df in frames]
+    if not frames:
+        return pd.DataFrame()
+    dtypes = {}
+    for df in frames:
+        for column, dtype in df.dtypes.items():
+            dtypes.setdefault(column, []).append(dtype)
+    for column, column_dtypes in dtypes.items():
+        dtype = column_dtypes[0]
+        if all(isinstance(other, pd.CategoricalDtype) for other in column_dtypes):
+            categories = pd.api.types.union_categoricals([df[column] for df in frames if column in df.columns]).categories
+            dtype = pd.CategoricalDtype(categories)
+            for df in frames:
+                if column in df.columns:
+                    df[column] = df[column].cat.set_categories(categories)
+        elif {str(other) for other in column_dtypes} == {'Int32', 'float32'}:
+            # counts with decimals in some pages, float32 as in _convert
+            dtype = np.dtype('float32')
+            for df in frames:
+                if column in df.columns:
+                    df[column] = df[column].astype(dtype)
+        for df in frames:
+            if column not in df.columns: # missing from all the documents of a page
+                df[column] = pd.Series(index=df.index, dtype=dtype)
+    return pd.concat(frames, ignore_index=True)[list(dtypes)]
+
+
+def apply_schema(df, schema):
+    """Convert the columns of an existing DataFrame found in `schema`."""
+    for column in df.columns:
+        if column in schema:
+            df[column] = _convert(df[column], schema[column])
+    return df
+
+
+def arrow_schema(df, schema):
+    """Arrow schema for writing `df` to Parquet: the columns found in
+    `schema` get a fixed type, so every chunk of a download is written the
+    same way; the rest are inferred from `df`.
+
+    """
+    import pyarrow as pa
+
+    types = {
+        'zone': pa.dictionary(pa.int32(), pa.string()),
+        'date': pa.date32(),
+        'int': pa.int32(),
+        'float': pa.float32(),
+    }
+    inferred = pa.Schema.from_pandas(df, preserve_index=False)
+    return pa.schema([
+        pa.field(field.name, types[schema[field.name]]) if field.name in schema else field
+        for field in inferred
+    ])
+
+
+def to_arrow(df, arrow_schema):
+    import pyarrow as pa
+
+    missing = [column for column in df.columns if column not in arrow_schema.names]
+    if missing:
+        raise Exception(f"Columns {', '.join(map(str, missing))} are not in the schema of the output, which was set by the first rows written")
+    arrays = []
+    for field in arrow_schema:
+        if field.name in df.columns:
+            array = pa.array(df[field.name], from_pandas=True)
+        else:
+            array = pa.nulls(len(df))
+        arrays.append(array.cast(field.type))
+    return pa.Table.from_arrays(arrays, schema=arrow_schema)
+
+
+def cast_to_schema(data, arrow_schema):
+    """Return the Arrow table or record batch `data` as a table with
+    `arrow_schema`, its missing columns filled with nulls.
+
+    """
+    import pyarrow as pa
+
+    arrays = [
+        data.column(field.name).cast(field.type) if field.name in data.schema.names else pa.nulls(data.num_rows, field.type)
+        for field in arrow_schema
+    ]
+    return pa.Table.from_arrays(arrays, schema=arrow_schema)
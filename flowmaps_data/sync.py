@@ -0,0 +1,102 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .utils import get_client, fetch_all_pages, save_df
+from .data import _daily_mobility_query, _daily_mobility_result
+from .schemas import get_schema
+
+
+# state of each store, next to its partitions. Files starting with '_' are
+# skipped by parquet readers.
+SYNC_STATE_FILE = '_sync.json'
+
+
+def _pair_dir(store_dir, source_layer, target_layer):
+    return os.path.join(store_dir, f'source_layer={source_layer}', f'target_layer={target_layer}')
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_state(path, state):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def daily_mobility_versions(client=None):
+    """Return the {date: processing time} of the daily mobility matrices
+    available in the API, from their provenance.
+
+    """
+    filters = {
+        'storedIn': 'mitma_mov.daily_mobility_matrix',
+        'numEntries': {'$gt': 0},
+    }
+    prov = fetch_all_pages('provenance', filters, sort='keywords.date', progress=False, client=client)
+    return {doc['keywords']['date']: doc.get('storedAt') for doc in prov}
+
+
+def _sync_date(source_layer, target_layer, date, store_dir, client):
+    collection, filters, projection = _daily_mobility_query(source_layer, target_layer, start_date=date, end_date=date)
+    data = fetch_all_pages(collection, filters, projection=projection, progress=False, client=client)
+    df = _daily_mobility_result(data)
+    save_df(df, store_dir, 'parquet-dataset', schema=get_schema(collection), partitions={'source_layer': source_layer, 'target_layer': target_layer})
+    return df.shape[0]
+
+
+def sync_daily_mobility(source_layer, target_layer, store_dir, start_date=None, end_date=None, max_workers=4, client=None):
+    """Bring the local store of daily mobility matrices in `store_dir` (a
+    parquet dataset partitioned by source_layer, target_layer and date) up
+    to date with the API.
+
+    Only the dates missing from the store, or processed again in the API
+    since they were synced, are downloaded, `max_workers` dates at a time.
+    Returns the list of synced dates.
+
+    """
+    versions = daily_mobility_versions(client=client)
+    state_path = os.path.join(_pair_dir(store_dir, source_layer, target_layer), SYNC_STATE_FILE)
+    state = _load_state(state_path)
+
+    pending = sorted(
+        date for date, version in versions.items()
+        if (not start_date or date >= start_date) and (not end_date or date <= end_date)
+        and (date not in state or state[date] != version)
+    )
+    if not pending:
+        print(f'Daily mobility for source_layer={source_layer} target_layer={target_layer} is up to date')
+        return []
+    print(f"Syncing {len(pending)} dates of daily mobility for source_layer={source_layer} target_layer={target_layer}: {', '.join(pending)}")
+
+    # pending dates may have been processed again since their pages were
+    # cached, ask the API for them
+    fetch_client = get_client(client).with_cache(refresh=True)
+    synced = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_sync_date, source_layer, target_layer, date, store_dir, fetch_client): date for date in pending}
+        for future in as_completed(futures):
+            date = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error syncing daily mobility for date {date}: {e}")
+                failed.append(date)
+                continue
+            # record each date as soon as it is stored, an interrupted sync
+            # resumes from the dates still missing
+            state[date] = versions[date]
+            _save_state(state_path, state)
+            synced.append(date)
+    if failed:
+        raise Exception(f"Failed to sync daily mobility for dates: {', '.join(sorted(failed))}")
+    return sorted(synced)
@@ -1,13 +1,211 @@
+import os
+import copy
 import requests
+from requests.adapters import HTTPAdapter
 import pytz
+import pandas as pd
 import json
+import math
+import time
+import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, chain
+from urllib.parse import urlsplit, parse_qsl
 from datetime import datetime, timedelta
 from progress.bar import Bar
 
+from .cache import ResponseCache
+from .decoders import get_decoder
+from .schemas import arrow_schema, to_arrow, cast_to_schema
+
 tz = pytz.timezone('Europe/Madrid')
 
 API_URL = "https://flowmaps.life.bsc.es/api"
 
+PAGINATION_MODES = ['page', 'keyset']
+
+SHARD_MODES = ['day', 'week']
+
+OUTPUT_FORMATS = ['csv', 'json', 'ndjson', 'parquet', 'parquet-dataset']
+
+DEFAULT_PAGE_SIZE = 1000
+
+# page sizes (max_results) used with page_size='auto'. Each one divides all
+# the larger ones, so pages of different sizes stay aligned
+ADAPTIVE_PAGE_SIZES = [25, 125, 250, 500, 1000, 2000, 4000, 8000]
+
+# seconds and bytes the adaptive page size aims for at most, per page
+TARGET_PAGE_TIME = 1.0
+MAX_PAGE_BYTES = 32 * 1024**2
+
+
+class PageSizer:
+    """Page sizes (max_results) tuned per collection, from the latency and
+    payload of the pages fetched so far.
+
+    Sizes grow one step while full pages take less than half of
+    `target_time`, and shrink as much as needed when a page takes longer or
+    carries more than `max_bytes`. A smaller max_results applied by the
+    server is kept as the limit of the collection.
+
+    """
+
+    def __init__(self, target_time=TARGET_PAGE_TIME, max_bytes=MAX_PAGE_BYTES, sizes=ADAPTIVE_PAGE_SIZES, initial_size=DEFAULT_PAGE_SIZE):
+        self.target_time = target_time
+        self.max_bytes = max_bytes
+        self.sizes = sorted(sizes)
+        self.initial_size = initial_size
+        self._sizes = {}
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def size(self, collection, offset=0):
+        """Return the size of the next page of `collection`, the one that
+        starts at document `offset`. It is the largest size up to the tuned
+        one that `offset` is a multiple of, so the page has a page number.
+
+        """
+        with self._lock:
+            size = min(self._sizes.get(collection, self.initial_size), self._limits.get(collection, math.inf))
+        aligned = [candidate for candidate in self.sizes if candidate <= size and offset % candidate == 0]
+        return aligned[-1] if aligned else math.gcd(offset, size)
+
+    def cap(self, collection, max_results):
+        with self._lock:
+            self._limits[collection] = min(max_results, self._limits.get(collection, max_results))
+
+    def record(self, collection, requested, applied, num_items, elapsed, num_bytes):
+        if applied is not None and applied < requested:
+            self.cap(collection, applied)
+        size = requested if applied is None else applied
+        # only pages of the tuned sizes count, not e.g. the single
+        # document of fetch_first
+        if not num_items or size not in self.sizes:
+            return
+        with self._lock:
+            if elapsed > self.target_time or num_bytes > self.max_bytes:
+                # time and bytes of the other sizes, estimated from this page
+                time_per_item, bytes_per_item = elapsed / num_items, num_bytes / num_items
+                fits = [
+                    candidate for candidate in self.sizes
+                    if candidate < size and candidate * time_per_item <= self.target_time and candidate * bytes_per_item <= self.max_bytes
+                ]
+                self._sizes[collection] = fits[-1] if fits else self.sizes[0]
+            elif num_items == size and elapsed < self.target_time / 2:
+                larger = [candidate for candidate in self.sizes if candidate > size]
+                if larger and larger[0] * num_bytes / num_items <= self.max_bytes:
+                    self._sizes[collection] = larger[0]
+                else:
+                    self._sizes[collection] = size
+            else:
+                self._sizes[collection] = size
+
+
+class FlowmapsClient:
+    """HTTP client for the FlowMaps API.
+
+    Keeps a pooled `requests.Session`, so consecutive pages reuse the same
+    connections instead of paying a new TCP+TLS handshake per request.
+    Responses are stored in `cache` (a `ResponseCache`) when given, and are
+    transferred gzip/deflate compressed unless `compress=False`. They are
+    decoded with the JSON `decoder` (see `get_decoder`), orjson or ujson
+    when installed.
+
+    Pages have `page_size` documents, or with page_size='auto' a size tuned
+    per collection by `page_sizer` (a `PageSizer`) and kept for the life of
+    the client.
+
+    """
+
+    def __init__(self, api_url=API_URL, pool_size=10, keep_alive=True, timeout=None, cache=None, compress=True, decoder='auto', page_size=DEFAULT_PAGE_SIZE, page_sizer=None):
+        if page_size != 'auto' and (not isinstance(page_size, int) or page_size < 1):
+            raise Exception(f"Unrecognized page_size '{page_size}'. Use a positive number of documents or auto")
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.cache = cache
+        self.loads = get_decoder(decoder)
+        self.page_size = page_size
+        self.page_sizer = page_sizer if page_sizer is not None else PageSizer()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate' if compress else 'identity'
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def get(self, path, params=None):
+        # next page links come with their parameters in the path
+        url = urlsplit(path)
+        collection, params = url.path, {**dict(parse_qsl(url.query)), **(params or {})}
+        if self.cache is None:
+            return self._fetch(collection, params)[1]
+        entry = self.cache.get(collection, params)
+        if entry is not None and self.cache.is_fresh(collection, entry):
+            return entry['response']
+
+        # revalidate expired entries, an unchanged page costs a 304 without payload
+        headers = {}
+        if entry is not None and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response, data = self._fetch(collection, params, headers=headers)
+        if response.status_code == 304:
+            data = entry['response']
+        if response.status_code in (200, 304):
+            etag = response.headers.get('ETag', entry and entry.get('etag'))
+            last_modified = response.headers.get('Last-Modified', entry and entry.get('last_modified'))
+            self.cache.set(collection, params, data, etag=etag, last_modified=last_modified)
+        return data
+
+    def with_cache(self, **options):
+        """Return a client sharing the connections of this one, with a view
+        of its cache changed by `options` (see `ResponseCache.view`), e.g.
+        refresh=True to ask the API again and store the new responses.
+
+        """
+        if self.cache is None:
+            return self
+        client = copy.copy(self)
+        client.cache = self.cache.view(**options)
+        return client
+
+    def _fetch(self, collection, params, headers=None):
+        # decode the response, and report the latency and payload of pages to
+        # the page sizer. Cached pages say nothing about the server.
+        start = time.monotonic()
+        response = self._request(collection, params, headers=headers)
+        if response.status_code == 304:
+            return response, None
+        data = self.loads(response.content)
+        if 'max_results' in params and isinstance(data, dict) and '_items' in data:
+            applied = data.get('_meta', {}).get('max_results')
+            self.page_sizer.record(collection, int(params['max_results']), applied, len(data['_items']), time.monotonic() - start, len(response.content))
+        return response, data
+
+    def _request(self, path, params=None, headers=None):
+        url = f"{self.api_url}/{path}"
+        return self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+default_client = FlowmapsClient(cache=ResponseCache())
+
+
+def get_client(client=None):
+    return client if client is not None else default_client
+
 
 def date_rfc1123(dt):
     """Return a string representation of a date according to RFC 1123
@@ -35,54 +233,417 @@ def clean_docs(docs):
     return docs
 
 
-def fetch_first(collection, query, projection={}):
-    base_url = API_URL
-    url = f"{base_url}/{collection}"
+def fetch_first(collection, query, projection={}, sort=None, client=None):
+    client = get_client(client)
     params = {'where': json.dumps(query), 'max_results': 1, 'projection': json.dumps(projection)}
-    # print(f"API url: {base_url}/{collection}?where={params['where']}&max_results={params['max_results']}&projection={params['projection']}")
-    response = requests.get(url, params=params).json()
+    if sort:
+        params['sort'] = sort
+    # print(f"API url: {client.api_url}/{collection}?where={params['where']}&max_results={params['max_results']}&projection={params['projection']}")
+    response = client.get(collection, params)
     if not response or not response.get('_items'):
         return None
     return response['_items'][0]
 
 
-def fetch_all_pages(collection, query, batch_size=1000, projection={}, sort=None, progress=True, print_url=False):
-    base_url = API_URL
-    url = f"{base_url}/{collection}"
+def shard_slice(items, shard):
+    """Return the part of `items` assigned to `shard`, an (i, N) tuple with
+    0 <= i < N. Each shard gets a contiguous block, so concatenating the
+    results of the shards in order gives back the original order.
+
+    """
+    items = list(items)
+    i, n = shard
+    return items[len(items) * i // n:len(items) * (i + 1) // n]
+
+
+def iter_pages(collection, query, batch_size=None, projection={}, sort=None, progress=True, print_url=False, max_workers=1, pagination='page', shard=None, client=None):
+    """Yield the documents matching `query` one page (a list of dicts) at a
+    time, in order, without keeping the previous pages in memory.
+
+    Pages have `batch_size` documents, by default the page_size of the
+    client. With 'auto', the size is tuned from page to page when they are
+    fetched one after the other, and taken from the last tuning otherwise.
+
+    With `shard=(i, N)` only the i-th of N contiguous blocks of pages is
+    fetched, so N independent processes can split one download.
+
+    """
+    client = get_client(client)
+    if pagination not in PAGINATION_MODES:
+        raise Exception(f"Unrecognized pagination '{pagination}'. Choose one from: {', '.join(PAGINATION_MODES)}")
+    if pagination == 'keyset':
+        if sort:
+            raise Exception('keyset pagination always sorts by _id, it cannot be combined with sort')
+        if max_workers > 1:
+            raise Exception('keyset pagination fetches pages one after the other, it cannot be combined with max_workers')
+        sort = '_id'
+        projection = {k: v for k, v in projection.items() if k != '_id'} # _id is needed to request the next page
+    if shard:
+        if pagination == 'keyset':
+            raise Exception('keyset pagination cannot jump to the pages of a shard, it cannot be combined with shard')
+        sort = sort or '_id' # every shard must see the pages in the same order
+    batch_size = batch_size or client.page_size
+    adaptive = batch_size == 'auto'
+    if adaptive:
+        batch_size = client.page_sizer.size(collection)
     params = {'where': json.dumps(query), 'max_results': batch_size, 'projection': json.dumps(projection)}
     if sort:
         params['sort'] = sort
-    data = []
     if print_url:
-        print(f"API request: {base_url}/{collection}?where={params['where']}")
-    response = requests.get(url, params=params).json() # get first page
-    data.extend(response['_items'])
+        print(f"API request: {client.api_url}/{collection}?where={params['where']}")
+    response = client.get(collection, params) # get first page
+    if pagination == 'keyset' and response['_items']:
+        # read it before handing out the page, the caller may modify the documents
+        last_id = response['_items'][-1]['_id']
+    if shard:
+        yield from _iter_shard_pages(client, collection, params, response, shard, max_workers, progress)
+        return
+    yield response['_items']
     if '_links' not in response:
-        return data
+        return
     num_docs = response['_meta']['total']
     if num_docs <= 0:
-        return data
+        return
+    num_fetched = len(response['_items'])
     if progress: bar = Bar('Dowloading documents', max=num_docs)
-    while 'next' in response['_links']:
-        if progress: bar.goto(len(data))
-        url = f"{base_url}/{response['_links']['next']['href']}"
-        response = requests.get(url).json()
-        data.extend(response['_items'])
-    if progress: bar.goto(len(data))
+    if max_workers > 1:
+        pages = _iter_pages_concurrently(client, collection, params, range(2, _num_pages(params, response) + 1), max_workers)
+    elif pagination == 'keyset':
+        pages = _iter_pages_by_key(client, collection, query, params, num_docs - num_fetched, last_id, adaptive)
+    elif adaptive:
+        pages = _iter_pages_adaptively(client, collection, params, num_fetched, num_docs)
+    else:
+        pages = _iter_pages_by_link(client, response)
+    for items in pages:
+        num_fetched += len(items)
+        if progress: bar.goto(num_fetched)
+        yield items
+    if progress: bar.goto(num_fetched)
     if progress: bar.finish()
+
+
+def fetch_all_pages(collection, query, batch_size=None, projection={}, sort=None, progress=True, print_url=False, max_workers=1, pagination='page', shard=None, client=None):
+    data = []
+    for items in iter_pages(collection, query, batch_size=batch_size, projection=projection, sort=sort, progress=progress, print_url=print_url, max_workers=max_workers, pagination=pagination, shard=shard, client=client):
+        data.extend(items)
     return data
 
 
-def save_df(df, output_file, output_format):
-    if output_format == 'csv':
-        df.to_csv(output_file, index=False)
-        print(f'{df.shape[0]} rows written to file:', output_file)
-    elif output_format == 'json':
-        with open(output_file, 'w') as f:
-            json.dump(df.to_dict('records'), f, indent=2)
-        print('Saved to file:', output_file)
-    elif output_format == 'parquet':
-        df.to_parquet(output_file)
-        print(f'{df.shape[0]} rows written to file:', output_file)
+def _iter_pages_by_link(client, response):
+    while 'next' in response['_links']:
+        response = client.get(response['_links']['next']['href'])
+        yield response['_items']
+
+
+def iter_chunks(pages, chunksize):
+    """Regroup `pages` (an iterable of lists of documents) into lists of
+    `chunksize` documents, the last one may be shorter.
+
+    """
+    chunk = []
+    for page in pages:
+        start = 0
+        while start < len(page):
+            end = start + chunksize - len(chunk)
+            chunk.extend(page[start:end])
+            start = end
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_pages_adaptively(client, collection, params, num_fetched, num_docs):
+    # the size may change from one page to the next, each page is asked for
+    # by its number at the size chosen for it
+    while num_fetched < num_docs:
+        size = client.page_sizer.size(collection, num_fetched)
+        response = client.get(collection, {**params, 'max_results': size, 'page': num_fetched // size + 1})
+        applied = response['_meta'].get('max_results', size)
+        if applied < size:
+            # capped by the server, the page starts elsewhere. Ask again with
+            # a size it accepts.
+            client.page_sizer.cap(collection, applied)
+            continue
+        if not response['_items']:
+            return
+        num_fetched += len(response['_items'])
+        yield response['_items']
+
+
+def _num_pages(params, response):
+    if '_links' not in response:
+        return 1
+    meta = response['_meta']
+    # the server may cap max_results, so use the page size it actually applied
+    page_size = meta.get('max_results', params['max_results'])
+    return max(1, math.ceil(meta['total'] / page_size))
+
+
+def _iter_shard_pages(client, collection, params, response, shard, max_workers, progress):
+    # the first page has already been fetched, to know the number of pages,
+    # but it is only handed out by the shard it belongs to
+    pages = shard_slice(range(1, _num_pages(params, response) + 1), shard)
+    if progress: bar = Bar('Dowloading pages', max=len(pages))
+    if 1 in pages:
+        if progress: bar.next()
+        yield response['_items']
+    for items in _iter_pages_concurrently(client, collection, params, [page for page in pages if page > 1], max_workers):
+        if progress: bar.next()
+        yield items
+    if progress: bar.finish()
+
+
+def _iter_pages_concurrently(client, collection, params, pages, max_workers):
+    pages = iter(pages)
+
+    def fetch_page(page):
+        return client.get(collection, {**params, 'page': page})['_items']
+
+    # keep a bounded window of pages in flight and hand them out in page
+    # order, so memory does not grow with the number of pages
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = deque(executor.submit(fetch_page, page) for page in islice(pages, 2 * max_workers))
+        while futures:
+            items = futures.popleft().result()
+            for page in islice(pages, 1):
+                futures.append(executor.submit(fetch_page, page))
+            yield items
+
+
+def _iter_pages_by_key(client, collection, query, params, num_pending, last_id, adaptive=False):
+    # ask for the documents after the last _id seen instead of following the
+    # page links, so the server walks the _id index rather than skipping over
+    # all the previous pages
+    while num_pending > 0:
+        key = {'_id': {'$gt': last_id}}
+        where = {'$and': [query, key]} if '_id' in query else {**query, **key}
+        if adaptive:
+            # no page numbers here, any size can follow any other
+            params = {**params, 'max_results': client.page_sizer.size(collection)}
+        items = client.get(collection, {**params, 'where': json.dumps(where)})['_items']
+        if not items:
+            return
+        num_pending -= len(items)
+        last_id = items[-1]['_id']
+        yield items
+
+
+def date_shards(start_date, end_date, shard_by='day'):
+    """Split the dates from `start_date` to `end_date` (both included) into
+    consecutive (start, end) ranges of one day or one week.
+
+    """
+    if shard_by not in SHARD_MODES:
+        raise Exception(f"Unrecognized shard_by '{shard_by}'. Choose one from: {', '.join(SHARD_MODES)}")
+    if not start_date or not end_date:
+        raise Exception('start_date and end_date are needed to split the query by date')
+    days = 1 if shard_by == 'day' else 7
+    start, end = datetime.strptime(start_date, '%Y-%m-%d'), datetime.strptime(end_date, '%Y-%m-%d')
+    shards = []
+    while start <= end:
+        shard_end = min(start + timedelta(days=days - 1), end)
+        shards.append((start.strftime('%Y-%m-%d'), shard_end.strftime('%Y-%m-%d')))
+        start = shard_end + timedelta(days=1)
+    return shards
+
+
+def iter_shards(queries, progress=True, print_url=False, max_workers=1, pagination='page', retries=3, client=None):
+    """Fetch the documents of each of the `queries` (a list of (collection,
+    filters, projection), e.g. one per date shard) and yield them one list
+    per query, in the same order.
+
+    Up to `max_workers` queries are fetched at a time, each one paging
+    through its own, smaller, result. A query that fails is retried on its
+    own up to `retries` times.
+
+    """
+    client = get_client(client)
+    if print_url and queries:
+        collection, filters, _ = queries[0]
+        print(f"API request: {client.api_url}/{collection}?where={json.dumps(filters)} (and {len(queries) - 1} more shards)")
+
+    def fetch_shard(query):
+        collection, filters, projection = query
+        for attempt in range(retries + 1):
+            try:
+                return fetch_all_pages(collection, filters, projection=projection, progress=False, pagination=pagination, client=client)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"Error fetching {collection} where={json.dumps(filters)}: {e}. Retrying...")
+                time.sleep(2 ** attempt)
+
+    if progress: bar = Bar('Dowloading shards', max=len(queries))
+    # same bounded, in order window as _iter_pages_concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = iter(queries)
+        futures = deque(executor.submit(fetch_shard, query) for query in islice(pending, 2 * max_workers))
+        while futures:
+            data = futures.popleft().result()
+            for query in islice(pending, 1):
+                futures.append(executor.submit(fetch_shard, query))
+            if progress: bar.next()
+            yield data
+    if progress: bar.finish()
+
+
+def save_df(df, output_file, output_format, schema=None, partitions=None):
+    """Write a DataFrame, or an iterable of DataFrames (e.g. the chunks
+    returned by the data functions when using chunksize), to a file.
+
+    Chunks are written as they arrive, so memory use does not depend on the
+    size of the output. `schema` (see `flowmaps_data.schemas`) fixes the
+    Parquet types of its columns, and writes its dates as plain days in JSON.
+
+    With output_format='parquet-dataset', `output_file` is a directory with
+    hive partitions (key=value subdirectories) by the `partitions` (a dict
+    of values shared by all the rows, e.g. {'ev': 'ES.covid_cpro'}) and by
+    date. Writing to an existing dataset only replaces the partitions
+    present in the new data, the rest are kept.
+
+    """
+    if output_format not in OUTPUT_FORMATS:
+        print(f"Unrecognized output_format. Choose one from: {', '.join(OUTPUT_FORMATS)}")
+        return
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    schema = schema or {}
+    if output_format == 'parquet':
+        num_rows = _write_parquet(chunks, output_file, schema)
+    elif output_format == 'parquet-dataset':
+        num_rows = _write_parquet_dataset(chunks, output_file, schema, partitions or {})
     else:
-        print('Unrecognized output_format. Choose one from: csv, json, parquet')
+        # csv files are read back if later chunks bring new columns
+        with open(output_file, 'w+' if output_format == 'csv' else 'w') as f:
+            if output_format == 'csv':
+                num_rows = _write_csv(chunks, f)
+            else:
+                num_rows = _write_json(chunks, f, schema, array=(output_format == 'json'))
+    print(f'{num_rows} rows written to file:', output_file)
+
+
+def _write_csv(chunks, f):
+    num_rows = 0
+    columns = None
+    for chunk in chunks:
+        if columns is None:
+            columns = list(chunk.columns)
+            chunk.to_csv(f, index=False)
+            num_rows += chunk.shape[0]
+            continue
+        new_columns = [column for column in chunk.columns if column not in columns]
+        if new_columns:
+            # fields first seen in this chunk, the rows already written get
+            # them empty
+            columns += new_columns
+            f.seek(0)
+            written = pd.read_csv(f, dtype=str, keep_default_na=False)
+            f.seek(0)
+            f.truncate()
+            written.reindex(columns=columns, fill_value='').to_csv(f, index=False)
+        chunk.reindex(columns=columns).to_csv(f, index=False, header=False)
+        num_rows += chunk.shape[0]
+    return num_rows
+
+
+def _write_json(chunks, f, schema, array=False):
+    # one compact record per line, either as a JSON array or as NDJSON
+    num_rows = 0
+    if array: f.write('[\n')
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        dates = {column: chunk[column].dt.strftime('%Y-%m-%d') for column in chunk.columns if schema.get(column) == 'date'}
+        if dates:
+            chunk = chunk.assign(**dates)
+        lines = chunk.to_json(orient='records', lines=True, date_format='iso').rstrip('\n')
+        if array:
+            if num_rows: f.write(',\n')
+            lines = lines.replace('\n', ',\n')
+        f.write(lines)
+        if not array: f.write('\n')
+        num_rows += chunk.shape[0]
+    if array: f.write('\n]\n')
+    return num_rows
+
+
+def _write_parquet(chunks, output_file, schema):
+    # each chunk becomes a row group, all of them with the schema of the first
+    # one, where the columns in `schema` get their registered types
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    num_rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            chunk_schema = arrow_schema(chunk, schema)
+            if writer is None:
+                writer = pq.ParquetWriter(output_file, chunk_schema)
+            else:
+                # columns that were all missing in the first chunks, or first
+                # seen in this one, widen the schema of the file
+                table_schema = pa.unify_schemas([writer.schema, chunk_schema], promote_options='permissive')
+                if not table_schema.equals(writer.schema):
+                    writer = _rewrite_parquet(writer, output_file, table_schema)
+            writer.write_table(to_arrow(chunk, writer.schema))
+            num_rows += chunk.shape[0]
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pq.write_table(pa.table({}), output_file) # no rows, but still leave a file
+    return num_rows
+
+
+def _rewrite_parquet(writer, output_file, table_schema):
+    # copy the row groups written so far into a new file with `table_schema`
+    import pyarrow.parquet as pq
+
+    writer.close()
+    tmp_path = f'{output_file}.{os.getpid()}.tmp'
+    os.replace(output_file, tmp_path)
+    writer = pq.ParquetWriter(output_file, table_schema)
+    for batch in pq.ParquetFile(tmp_path).iter_batches():
+        writer.write_table(cast_to_schema(batch, table_schema))
+    os.remove(tmp_path)
+    return writer
+
+
+def _write_parquet_dataset(chunks, output_dir, schema, partitions):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    chunks = (chunk.assign(**partitions) for chunk in chunks if not chunk.empty)
+    first = next(chunks, None)
+    if first is None:
+        os.makedirs(output_dir, exist_ok=True)
+        return 0
+    partition_columns = list(partitions) + (['date'] if 'date' in first.columns else [])
+    if 'date' not in partition_columns and os.path.isdir(output_dir) and os.listdir(output_dir):
+        # the partitions written would replace all the existing data
+        raise Exception(f'Rows without a date can not be added to the existing dataset: {output_dir}')
+    # the partition values are written as directory names, keep them as plain strings
+    table_schema = arrow_schema(first, {column: kind for column, kind in schema.items() if column not in partitions})
+    # columns all missing in the first chunk are kept as strings, the schema
+    # of a dataset can not be widened later
+    table_schema = pa.schema([
+        pa.field(field.name, pa.string()) if field.name in partitions or pa.types.is_null(field.type) else field
+        for field in table_schema
+    ])
+    partitioning = ds.partitioning(pa.schema([table_schema.field(column) for column in partition_columns]), flavor='hive')
+
+    num_rows = 0
+    def batches():
+        nonlocal num_rows
+        for chunk in chain([first], chunks):
+            num_rows += chunk.shape[0]
+            yield from to_arrow(chunk, table_schema).to_batches()
+
+    # new files get a unique name, and only the partitions being written are
+    # cleared, so appending new dates does not touch the existing ones
+    ds.write_dataset(batches(), output_dir, schema=table_schema, format='parquet', partitioning=partitioning,
+                     basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+                     existing_data_behavior='delete_matching')
+    return num_rows
@@ -0,0 +1,239 @@
+import os
+import numpy as np
+import pandas as pd
+
+from .utils import get_client
+from .data import geolayer, layer_version
+from .geo import polygons
+
+
+# average number of polygon edges per cell of the grid
+EDGES_PER_CELL = 1
+
+# (point, edge) pairs tested at a time, bounds the memory used by lookups
+MAX_PAIRS = 4 * 1024**2
+
+ZONE_INDEX_ARRAYS = [
+    'ids', 'centroids', 'edges', 'edge_zones', 'cell_indptr', 'cell_edges', 'cell_zones', 'grid',
+]
+
+
+def _ring_edges(ring):
+    ring = np.asarray(ring, dtype=np.float64)[:, :2]
+    if len(ring) and (ring[0] != ring[-1]).any():
+        ring = np.vstack([ring, ring[:1]])
+    return np.hstack([ring[:-1], ring[1:]])
+
+
+def _gather(indptr, values, rows):
+    # the values of the given rows of a CSR structure, and the position of
+    # the row they come from
+    counts = indptr[rows + 1] - indptr[rows]
+    owners = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.repeat(indptr[rows] - (np.cumsum(counts) - counts), counts)
+    return owners, values[offsets + np.arange(counts.sum())]
+
+
+class ZoneIndex:
+    """Spatial index of the zones of a layer, to find the zone of many
+    points at once.
+
+    The extent of the layer is split into a grid of cells, each one with
+    the polygon edges that cross it and the zone of its center. The zone of
+    a point is the zone of the center of its cell, changed by each edge
+    crossed on the way from the center to the point. Each lookup only tests
+    the few edges of a cell, with vectorized NumPy operations.
+
+    """
+
+    def __init__(self, ids, centroids, edges, edge_zones, cell_indptr, cell_edges, cell_zones, grid):
+        self.ids = np.asarray(ids)
+        self.centroids = centroids
+        self.edges = edges
+        self.edge_zones = edge_zones
+        self.cell_indptr = cell_indptr
+        self.cell_edges = cell_edges
+        self.cell_zones = cell_zones
+        self.grid = grid # minx, miny, dx, dy, nx, ny
+
+    def __repr__(self):
+        return f'<ZoneIndex zones={len(self.ids)} edges={len(self.edges)} cells={len(self.cell_zones)}>'
+
+    @classmethod
+    def from_geolayer(cls, featureCollection):
+        """Build the index of the (Multi)Polygon features of a layer, as
+        returned by `geolayer`.
+
+        """
+        features = featureCollection['features']
+        ids = [feature['id'] for feature in features]
+        centroids = np.array([feature.get('centroid') or [np.nan, np.nan] for feature in features], dtype=np.float64).reshape(-1, 2)
+        edges, edge_zones = [], []
+        for zone, feature in enumerate(features):
+            for polygon in polygons(feature.get('geometry')):
+                for ring in polygon:
+                    ring_edges = _ring_edges(ring)
+                    edges.append(ring_edges)
+                    edge_zones.append(np.full(len(ring_edges), zone, dtype=np.int32))
+        if not edges:
+            raise Exception('No polygons found in layer')
+        edges = np.vstack(edges)
+        edge_zones = np.concatenate(edge_zones)
+
+        # the grid leaves a margin around the polygons, so its left side is
+        # outside of all of them
+        minx, maxx = min(edges[:, 0].min(), edges[:, 2].min()), max(edges[:, 0].max(), edges[:, 2].max())
+        miny, maxy = min(edges[:, 1].min(), edges[:, 3].min()), max(edges[:, 1].max(), edges[:, 3].max())
+        margin = 1e-6 * max(maxx - minx, maxy - miny, 1)
+        minx, miny, maxx, maxy = minx - margin, miny - margin, maxx + margin, maxy + margin
+        num_cells = max(1, len(edges) // EDGES_PER_CELL)
+        nx = max(1, int(round(np.sqrt(num_cells * (maxx - minx) / (maxy - miny)))))
+        ny = max(1, int(np.ceil(num_cells / nx)))
+        dx, dy = (maxx - minx) / nx, (maxy - miny) / ny
+        grid = np.array([minx, miny, dx, dy, nx, ny], dtype=np.float64)
+
+        # every edge goes to all the cells its bounding box overlaps
+        ix0 = np.clip(((np.minimum(edges[:, 0], edges[:, 2]) - minx) // dx).astype(np.int64), 0, nx - 1)
+        ix1 = np.clip(((np.maximum(edges[:, 0], edges[:, 2]) - minx) // dx).astype(np.int64), 0, nx - 1)
+        iy0 = np.clip(((np.minimum(edges[:, 1], edges[:, 3]) - miny) // dy).astype(np.int64), 0, ny - 1)
+        iy1 = np.clip(((np.maximum(edges[:, 1], edges[:, 3]) - miny) // dy).astype(np.int64), 0, ny - 1)
+        width = ix1 - ix0 + 1
+        counts = width * (iy1 - iy0 + 1)
+        edge_ids = np.repeat(np.arange(len(edges)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (iy0[edge_ids] + k // width[edge_ids]) * nx + ix0[edge_ids] + k % width[edge_ids]
+        order = np.argsort(cells, kind='stable')
+        cell_edges = edge_ids[order].astype(np.int32)
+        cell_indptr = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=nx * ny))]).astype(np.int64)
+
+        index = cls(ids, centroids, edges, edge_zones, cell_indptr, cell_edges, np.full(nx * ny, -1, dtype=np.int32), grid)
+        index._locate_cell_centers()
+        return index
+
+    @classmethod
+    def from_layer(cls, layer, client=None):
+        """Return the index of `layer`. It is kept in the cache of the
+        client, next to the geometry of the layer, and built again only when
+        a new version of the layer is published.
+
+        """
+        cache = get_client(client).cache
+        version = layer_version(layer, client=client) if cache is not None else None
+        path = cache.layer_path(layer, version, '.index.npz') if version is not None else None
+        if path and not cache.refresh and os.path.exists(path):
+            return cls.open(path)
+        index = cls.from_geolayer(geolayer(layer, client=client))
+        if path:
+            index.save(path)
+        return index
+
+    def save(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **{name: getattr(self, name) for name in ZONE_INDEX_ARRAYS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in ZONE_INDEX_ARRAYS})
+
+    def _centers(self, cells):
+        minx, miny, dx, dy, nx, _ = self.grid
+        return np.column_stack([minx + (cells % int(nx) + .5) * dx, miny + (cells // int(nx) + .5) * dy])
+
+    def _cross(self, starts, ends, cells, start_zones):
+        # zone of each end, from the zone of its start and the edges of its
+        # cell crossed by the segment between them
+        zones = np.full(len(starts), -1, dtype=np.int32)
+        pairs = np.cumsum(self.cell_indptr[cells + 1] - self.cell_indptr[cells])
+        start = 0
+        while start < len(starts):
+            done = pairs[start - 1] if start else 0
+            end = max(start + 1, int(np.searchsorted(pairs, done + MAX_PAIRS, side='right')))
+            batch = np.arange(start, end)
+            owners, edge_ids = _gather(self.cell_indptr, self.cell_edges, cells[batch])
+            a, b = starts[batch][owners], ends[batch][owners]
+            p, q = self.edges[edge_ids, :2], self.edges[edge_ids, 2:]
+            # both ends of the segment on opposite sides of the edge, and
+            # both ends of the edge on opposite sides of the segment. Ends
+            # lying on the other line count as being on the negative side,
+            # so vertices are crossed once.
+            d1 = (q[:, 0] - p[:, 0]) * (a[:, 1] - p[:, 1]) - (q[:, 1] - p[:, 1]) * (a[:, 0] - p[:, 0])
+            d2 = (q[:, 0] - p[:, 0]) * (b[:, 1] - p[:, 1]) - (q[:, 1] - p[:, 1]) * (b[:, 0] - p[:, 0])
+            d3 = (b[:, 0] - a[:, 0]) * (p[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (p[:, 0] - a[:, 0])
+            d4 = (b[:, 0] - a[:, 0]) * (q[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (q[:, 0] - a[:, 0])
+            crossed = ((d1 > 0) != (d2 > 0)) & ((d3 > 0) != (d4 > 0))
+
+            # each crossing toggles a zone, the end is in the zones toggled
+            # an odd number of times
+            num_zones = len(self.ids)
+            keys = owners[crossed].astype(np.int64) * num_zones + self.edge_zones[edge_ids[crossed]]
+            inside = start_zones[batch] >= 0
+            keys = np.concatenate([keys, np.flatnonzero(inside) * num_zones + start_zones[batch][inside]])
+            keys, toggles = np.unique(keys, return_counts=True)
+            keys = keys[toggles % 2 == 1]
+            zones[batch[keys // num_zones]] = keys % num_zones
+            start = end
+        return zones
+
+    def _locate_cell_centers(self):
+        # walk each row of cells from its left side, outside of all the
+        # zones, to the center of each cell in turn
+        minx, miny, dx, dy, nx, ny = self.grid
+        nx, ny = int(nx), int(ny)
+        rows = np.arange(ny)
+        zones = np.full(ny, -1, dtype=np.int32)
+        previous = None
+        for column in range(nx):
+            cells = rows * nx + column
+            left = np.column_stack([np.full(ny, minx + column * dx), miny + (rows + .5) * dy])
+            if column:
+                zones = self._cross(previous, left, cells - 1, zones)
+            centers = self._centers(cells)
+            zones = self._cross(left, centers, cells, zones)
+            self.cell_zones[cells] = zones
+            previous = centers
+
+    def locate(self, lon, lat):
+        """Return the position in `ids` of the zone of each point, -1 for
+        the points outside of all the zones.
+
+        """
+        points = np.column_stack([np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)])
+        minx, miny, dx, dy, nx, ny = self.grid
+        ix = np.floor((points[:, 0] - minx) / dx)
+        iy = np.floor((points[:, 1] - miny) / dy)
+        valid = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        zones = np.full(len(points), -1, dtype=np.int32)
+        cells = (iy[valid] * nx + ix[valid]).astype(np.int64)
+        zones[valid] = self._cross(self._centers(cells), points[valid], cells, self.cell_zones[cells])
+        return zones
+
+    def nearest(self, lon, lat):
+        """Return the position in `ids` of the zone with the nearest
+        centroid to each point.
+
+        """
+        points = np.column_stack([np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)])
+        centroids = np.nan_to_num(self.centroids, nan=np.inf)
+        zones = np.empty(len(points), dtype=np.int32)
+        step = max(1, MAX_PAIRS // max(1, len(centroids)))
+        for start in range(0, len(points), step):
+            chunk = points[start:start + step]
+            distances = ((chunk[:, None, :] - centroids[None, :, :])**2).sum(axis=2)
+            zones[start:start + step] = distances.argmin(axis=1)
+        return zones
+
+    def lookup(self, lon, lat, nearest=False):
+        """Return the zone id of each point (given by arrays of longitudes
+        and latitudes) as a Categorical, missing for the points outside of
+        all the zones. With `nearest`, those points get the zone with the
+        nearest centroid instead.
+
+        """
+        zones = self.locate(lon, lat)
+        if nearest:
+            outside = zones < 0
+            if outside.any():
+                zones[outside] = self.nearest(np.asarray(lon)[outside], np.asarray(lat)[outside])
+        return pd.Categorical.from_codes(zones, categories=self.ids)